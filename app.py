@@ -5,22 +5,94 @@ Run:
   python app.py
 
 The app serves static files from `web/` and exposes simple API endpoints under `/api/`.
-This is a prototype: authentication is minimal and passwords are stored as plain text for demo purposes only.
+This is a prototype: authentication is minimal; passwords are stored as salted PBKDF2 hashes (see db.hash_password).
 """
 from flask import Flask, request, jsonify, send_from_directory, session, redirect, g
 from pathlib import Path
 import db
 from datetime import datetime
 import os
+import secrets
 
 app = Flask(__name__, static_folder='web', static_url_path='')
-app.secret_key = 'dev-secret-erp'  # change for production
+
+# Use orjson for response serialization when available — it is a C extension
+# several times faster than stdlib json on the larger payloads (products,
+# debug dump/logs). Optional: stdlib json is used when it isn't installed.
+try:
+    import orjson
+    from flask.json.provider import JSONProvider
+
+    class _OrjsonProvider(JSONProvider):
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = _OrjsonProvider(app)
+except ImportError:
+    pass
+# SECRET_KEY must be shared across gunicorn workers so signed session cookies
+# verify on every worker. When the env var isn't set, generate a key once and
+# persist it under data/ — each worker (and each restart) then loads the same
+# key, instead of every worker signing with its own random key and logging
+# users out on the first cross-worker request.
+def _load_secret_key() -> str:
+    key = os.environ.get('SECRET_KEY')
+    if key:
+        return key
+    key_file = Path(__file__).parent / 'data' / '.secret_key'
+    try:
+        return key_file.read_text().strip()
+    except OSError:
+        pass
+    key = secrets.token_hex(32)
+    try:
+        key_file.parent.mkdir(parents=True, exist_ok=True)
+        # O_EXCL so concurrent workers racing to create the file can't each
+        # persist a different key; the loser re-reads the winner's
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(key)
+    except FileExistsError:
+        return key_file.read_text().strip()
+    except OSError:
+        import logging
+        logging.error(
+            'SECRET_KEY is not set and %s is not writable: sessions will not '
+            'survive restarts and will break across gunicorn workers', key_file)
+    return key
+
+
+app.secret_key = _load_secret_key()
 # Configure session cookie options useful when hosting behind a different origin/proxy
 # SESSION_COOKIE_SAMESITE: set to 'None' in environments where cookies must be sent cross-site
 # SESSION_COOKIE_SECURE: set to '1' in the environment when serving over HTTPS in production
 app.config['SESSION_COOKIE_SAMESITE'] = os.environ.get('SESSION_COOKIE_SAMESITE', 'None')
 app.config['SESSION_COOKIE_SECURE'] = os.environ.get('SESSION_COOKIE_SECURE', '0') == '1'
 app.config['SESSION_COOKIE_HTTPONLY'] = True
+# When running behind nginx/apache set USE_X_SENDFILE=1 so Flask hands static
+# file serving off to the front server instead of streaming bytes in Python.
+app.use_x_sendfile = os.environ.get('USE_X_SENDFILE', '0') == '1'
+
+# Server-side sessions: when SESSION_REDIS_URL is set (and redis/flask-session
+# are installed) sessions live in Redis, so each request does one O(1) key
+# lookup instead of verifying the itsdangerous-signed cookie, and sessions are
+# shared across gunicorn workers. Falls back to signed cookies otherwise.
+from datetime import timedelta
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=8)
+_session_redis_url = os.environ.get('SESSION_REDIS_URL')
+if _session_redis_url:
+    try:
+        import redis
+        from flask_session import Session
+        app.config['SESSION_TYPE'] = 'redis'
+        app.config['SESSION_REDIS'] = redis.Redis.from_url(_session_redis_url)
+        Session(app)
+    except Exception as e:
+        import logging
+        logging.warning('SESSION_REDIS_URL set but Redis sessions unavailable (%s); using cookie sessions', e)
 
 # Ensure database is initialized at startup (creates tables and default users).
 try:
@@ -33,40 +105,126 @@ except Exception as e:
 # simple timing for request logging
 import time
 
-@app.before_request
-def _start_timer():
-    g.request_start = time.time()
+# --- background API-log writer ---
+# api_logs rows are queued and batch-written by db.log_api's background
+# flusher, so the request path never pays a SQLite commit per response.
+import threading
+
+# --- short-TTL cache for read-mostly list endpoints ---
+# Products/sources/inventory change only through the few admin write routes
+# below, so GETs can serve a cached copy for a few seconds instead of hitting
+# SQLite every poll. Cache-aside with explicit invalidation on every write
+# path that touches the underlying tables (orders also adjust stock).
+_READ_CACHE: dict = {}
+_READ_CACHE_TTL = 30  # seconds
+_read_cache_lock = threading.Lock()
+
+
+def _cached(key, loader):
+    now = time.time()
+    with _read_cache_lock:
+        hit = _READ_CACHE.get(key)
+        if hit is not None and hit[0] > now:
+            return hit[1]
+    val = loader()
+    with _read_cache_lock:
+        _READ_CACHE[key] = (now + _READ_CACHE_TTL, val)
+    return val
+
+
+def _invalidate_cache(*keys):
+    with _read_cache_lock:
+        if keys:
+            for k in keys:
+                _READ_CACHE.pop(k, None)
+        else:
+            _READ_CACHE.clear()
+
+
+# --- concurrency limiter for expensive endpoints ---
+# Uploads and full-table exports do unbounded work per request; without a cap
+# a handful of parallel calls can pin every worker thread and starve the rest
+# of the API. Per-process semaphores bound them (the Redis ZSET variant of
+# this pattern applies once the app runs multi-host).
+import functools
+
+
+def concurrency_limit(limit: int):
+    sem = threading.BoundedSemaphore(limit)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not sem.acquire(blocking=False):
+                return jsonify({'error': 'too many concurrent requests, retry shortly'}), 429
+            try:
+                rv = fn(*args, **kwargs)
+            except Exception:
+                sem.release()
+                raise
+            # hold the slot until the (possibly streamed) response finishes
+            resp = app.make_response(rv)
+            resp.call_on_close(sem.release)
+            return resp
+        return wrapper
+    return decorator
+
+
+# read once at import; re-reading os.environ on every request is wasted work
+_CORS_ORIGIN = os.environ.get('CORS_ALLOW_ORIGIN')
+# the non-origin CORS headers never vary, so build them once and apply with a
+# single headers.update instead of four inserts per response
+_CORS_STATIC_HEADERS = {
+    'Access-Control-Allow-Credentials': 'true',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+}
+
+
+def _apply_cors(resp):
+    origin = request.headers.get('Origin')
+    if _CORS_ORIGIN == 'auto' and origin:
+        resp.headers['Access-Control-Allow-Origin'] = origin
+    else:
+        resp.headers['Access-Control-Allow-Origin'] = _CORS_ORIGIN
+    resp.headers.update(_CORS_STATIC_HEADERS)
+
 
 @app.before_request
-def _handle_options_request():
-    # Respond to CORS preflight (OPTIONS) requests when CORS_ALLOW_ORIGIN is set
+def _before_request():
+    # single hook: start the request timer and answer CORS preflights.
+    # Flask calls each before_request callback per request, so keeping one
+    # callable instead of two saves a Python call on every request.
+    # Static assets skip all of it (they're never logged, so no timer needed).
+    if request.path.startswith(('/assets', '/static')):
+        return
+    g.request_start = time.time()
     if request.method == 'OPTIONS':
         try:
             resp = app.make_response(('', 200))
-            cors_origin = os.environ.get('CORS_ALLOW_ORIGIN')
-            if cors_origin:
-                origin = request.headers.get('Origin')
-                if cors_origin == 'auto' and origin:
-                    resp.headers['Access-Control-Allow-Origin'] = origin
-                else:
-                    resp.headers['Access-Control-Allow-Origin'] = cors_origin
-                resp.headers['Access-Control-Allow-Credentials'] = 'true'
-                resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-                resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+            if _CORS_ORIGIN:
+                _apply_cors(resp)
             return resp
         except Exception:
             return ('', 200)
 
 @app.after_request
 def _log_request(response):
+    # static assets skip logging and header work entirely — ideally they never
+    # reach Flask at all (serve /assets/ from nginx in production, see README)
+    if request.path.startswith(('/assets', '/static')):
+        return response
     try:
-        # avoid logging static file requests
-        if request.path.startswith('/assets') or request.path.startswith('/static'):
-            return response
-        # collect details
+        # collect details — never materialize large bodies just to log them:
+        # uploads and anything over the truncation limit log a size marker only
         payload = None
         try:
-            payload = request.get_data(as_text=True)[:2000]
+            if request.mimetype.startswith('multipart/'):
+                payload = f"<multipart {request.content_length or 0} bytes>"
+            elif request.content_length and request.content_length > 2000:
+                payload = f"<{request.content_length} bytes>"
+            else:
+                payload = request.get_data(as_text=True)[:2000]
         except Exception:
             payload = None
         user = session.get('user') if session else None
@@ -75,23 +233,15 @@ def _log_request(response):
         if hasattr(g, 'request_start'):
             duration_ms = int((time.time() - g.request_start) * 1000)
         ip = request.remote_addr
-        # log asynchronously best-effort (don't block response)
+        # enqueue for db's background flusher; it drops rather than blocks
         try:
-            db.log_api_call(method=request.method, path=request.path, status=response.status_code, user_id=user_id, payload=payload, duration_ms=duration_ms, ip=ip)
+            db.log_api(request.method, request.path, status=response.status_code, user_id=user_id, payload=payload, duration_ms=duration_ms, ip=ip)
         except Exception:
             pass
         # If hosting under a different origin, allow setting CORS origin via env var
         try:
-            cors_origin = os.environ.get('CORS_ALLOW_ORIGIN')
-            if cors_origin:
-                origin = request.headers.get('Origin')
-                if cors_origin == 'auto' and origin:
-                    response.headers['Access-Control-Allow-Origin'] = origin
-                else:
-                    response.headers['Access-Control-Allow-Origin'] = cors_origin
-                response.headers['Access-Control-Allow-Credentials'] = 'true'
-                response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-                response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+            if _CORS_ORIGIN:
+                _apply_cors(response)
         except Exception:
             pass
     except Exception:
@@ -99,21 +249,38 @@ def _log_request(response):
     return response
 
 
+def _send_html(filename):
+    """Serve a static HTML page with ETag support so repeat SPA navigations
+    get a 304 Not Modified instead of re-downloading the full page."""
+    try:
+        st = os.stat(Path(app.static_folder) / filename)
+        etag = f'{int(st.st_mtime)}-{st.st_size:x}'
+    except OSError:
+        return app.send_static_file(filename)
+    if request.if_none_match.contains(etag):
+        resp = app.make_response(('', 304))
+    else:
+        resp = app.make_response(app.send_static_file(filename))
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
 @app.route('/')
 def index():
-    return app.send_static_file('index.html')
+    return _send_html('index.html')
 
 
 @app.route('/login')
 def login_page():
-    return app.send_static_file('login.html')
+    return _send_html('login.html')
 
 
 @app.route('/dashboard')
 def dashboard_page():
     if 'user' not in session:
         return redirect('/')
-    return app.send_static_file('index.html')
+    return _send_html('index.html')
 
 
 @app.route('/api/login', methods=['POST'])
@@ -151,7 +318,6 @@ def api_login():
                         return jsonify({'error': 'admin login requires password'}), 403
         else:
             # no username provided: create a guest user for this session
-            import secrets, time
             guest_name = f"guest-{int(time.time())}-{secrets.token_hex(3)}"
             user = db.create_user(guest_name, password='', role='user')
 
@@ -161,8 +327,12 @@ def api_login():
     if role and user.get('role') != role:
         return jsonify({'error': f'Invalid role — user is {user.get("role")}, not {role}'}), 403
 
-    session['user'] = {'id': user['id'], 'username': user['username'], 'role': user['role']}
-    return jsonify({'ok': True, 'user': session['user']})
+    new_user = {'id': user['id'], 'username': user['username'], 'role': user['role']}
+    # only touch the session when the login actually changes it — writing an
+    # identical dict would still re-sign and re-send the cookie
+    if session.get('user') != new_user:
+        session['user'] = new_user
+    return jsonify({'ok': True, 'user': new_user})
 
 
 @app.route('/api/whoami')
@@ -173,10 +343,16 @@ def api_whoami():
     return jsonify({'user': u})
 
 
+# constant body + short max-age: the SPA polls this several times a second,
+# so let the browser/proxy short-circuit it instead of paying jsonify
+_PING_RESPONSE = ('{"ok":true}', 200, {'Content-Type': 'application/json',
+                                       'Cache-Control': 'public, max-age=2'})
+
+
 @app.route('/api/ping')
 def api_ping():
     """Simple health endpoint used by the SPA to detect backend availability."""
-    return jsonify({'ok': True})
+    return _PING_RESPONSE
 
 
 @app.route('/api/logout', methods=['POST'])
@@ -187,8 +363,12 @@ def api_logout():
 
 @app.route('/api/products')
 def api_products():
-    prods = db.list_products()
-    return jsonify(prods)
+    prods = _cached('products', db.list_products)
+    resp = jsonify(prods)
+    # let clients revalidate with If-None-Match instead of re-downloading
+    resp.add_etag()
+    resp.headers['Cache-Control'] = 'private, max-age=10'
+    return resp.make_conditional(request)
 
 
 @app.route('/api/products', methods=['POST'])
@@ -202,6 +382,7 @@ def api_create_product():
     if not name or unit_price is None:
         return jsonify({'error': 'name and unit_price required'}), 400
     p = db.add_product(name, float(unit_price))
+    _invalidate_cache('products')
     return jsonify(p), 201
 
 
@@ -215,18 +396,16 @@ def api_update_product(product_id):
     unit_price = data.get('unit_price')
 
     if unit_price is not None and name is None:
-        cur = db.connect().cursor()
-        cur.execute("SELECT name FROM products WHERE id = ?", (product_id,))
-        row = cur.fetchone()
-        if not row:
+        name = db.get_product_name(product_id)
+        if name is None:
             return jsonify({'error': 'product not found'}), 404
-        name = row[0]
 
     if not name or unit_price is None:
         return jsonify({'error': 'name and unit_price required'}), 400
     p = db.update_product(product_id, name, float(unit_price))
     if not p:
         return jsonify({'error': 'not found'}), 404
+    _invalidate_cache('products', 'inventory', 'product_sources')
     return jsonify(p)
 
 
@@ -238,6 +417,7 @@ def api_delete_product(product_id):
     ok = db.delete_product(product_id)
     if not ok:
         return jsonify({'error': 'not found'}), 404
+    _invalidate_cache('products', 'inventory', 'product_sources')
     return jsonify({'ok': True})
 
 
@@ -299,6 +479,8 @@ def api_orders():
         return jsonify({'error': str(ve)}), 400
     except Exception as e:
         return jsonify({'error': 'failed to create order', 'detail': str(e)}), 500
+    # orders consume source/inventory stock
+    _invalidate_cache('inventory', 'sources')
     return jsonify(order)
 
 
@@ -307,7 +489,7 @@ def api_list_stock():
     u = session.get('user')
     if not u:
         return jsonify({'error': 'unauthenticated'}), 401
-    return jsonify(db.list_inventory())
+    return jsonify(_cached('inventory', db.list_inventory))
 
 
 @app.route('/api/stock', methods=['POST'])
@@ -322,6 +504,7 @@ def api_create_stock():
     except Exception:
         return jsonify({'error': 'invalid payload'}), 400
     rec = db.set_inventory(product_id=product_id, quantity=quantity)
+    _invalidate_cache('inventory')
     return jsonify(rec), 201
 
 
@@ -336,6 +519,7 @@ def api_update_stock(product_id):
     except Exception:
         return jsonify({'error': 'invalid quantity'}), 400
     rec = db.set_inventory(product_id=product_id, quantity=quantity)
+    _invalidate_cache('inventory')
     return jsonify(rec)
 
 
@@ -347,6 +531,7 @@ def api_delete_stock(product_id):
     ok = db.delete_inventory(product_id)
     if not ok:
         return jsonify({'error': 'not found'}), 404
+    _invalidate_cache('inventory')
     return jsonify({'ok': True})
 
 
@@ -355,7 +540,7 @@ def api_list_sources():
     u = session.get('user')
     if not u:
         return jsonify({'error': 'unauthenticated'}), 401
-    return jsonify(db.list_sources())
+    return jsonify(_cached('sources', db.list_sources))
 
 
 @app.route('/api/sources', methods=['POST'])
@@ -373,6 +558,7 @@ def api_create_source():
     if not name:
         return jsonify({'error': 'name required'}), 400
     s = db.add_source(name=name, unit=unit, quantity=quantity)
+    _invalidate_cache('sources')
     return jsonify(s), 201
 
 
@@ -392,6 +578,7 @@ def api_update_source(source_id):
     s = db.update_source(source_id, name=name, unit=unit, quantity=q)
     if not s:
         return jsonify({'error': 'not found'}), 404
+    _invalidate_cache('sources', 'product_sources')
     return jsonify(s)
 
 
@@ -403,6 +590,7 @@ def api_delete_source(source_id):
     ok = db.delete_source(source_id)
     if not ok:
         return jsonify({'error': 'not found'}), 404
+    _invalidate_cache('sources', 'product_sources')
     return jsonify({'ok': True})
 
 
@@ -411,7 +599,7 @@ def api_list_product_sources():
     u = session.get('user')
     if not u:
         return jsonify({'error': 'unauthenticated'}), 401
-    return jsonify(db.list_product_sources())
+    return jsonify(_cached('product_sources', db.list_product_sources))
 
 
 @app.route('/api/product_sources', methods=['POST'])
@@ -427,6 +615,7 @@ def api_set_product_source():
     except Exception:
         return jsonify({'error': 'invalid payload'}), 400
     rec = db.set_product_source(product_id=product_id, source_id=source_id, factor=factor)
+    _invalidate_cache('product_sources')
     return jsonify(rec), 201
 
 
@@ -435,13 +624,9 @@ def api_delete_product_source(product_id):
     u = session.get('user')
     if not u or u.get('role') != 'admin':
         return jsonify({'error': 'forbidden'}), 403
-    conn = db.connect()
-    cur = conn.cursor()
-    cur.execute('DELETE FROM product_sources WHERE product_id = ?', (product_id,))
-    changed = cur.rowcount
-    conn.commit(); conn.close()
-    if not changed:
+    if not db.delete_product_source(product_id):
         return jsonify({'error': 'not found'}), 404
+    _invalidate_cache('product_sources')
     return jsonify({'ok': True})
 
 
@@ -477,18 +662,42 @@ def api_debug_logs():
     return jsonify(logs)
 
 
+# uploads are written by a small background pool so the request thread only
+# pays for reading the body, not the disk write
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.utils import secure_filename
+_upload_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image-writer')
+
+# resolved and created once at import; per-request mkdir was a stat syscall
+# (or three Path allocations) on every upload
+_IMAGES_DIR = Path(app.static_folder, 'assets', 'images')
+_IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def _write_upload(dest: Path, data: bytes):
+    try:
+        dest.write_bytes(data)
+    except Exception:
+        import logging
+        logging.exception('failed to persist upload %s', dest)
+
+
 @app.route('/api/upload_image', methods=['POST'])
+@concurrency_limit(5)
 def api_upload_image():
     if 'file' not in request.files:
         return jsonify({'error': 'no file provided'}), 400
     f = request.files['file']
     if f.filename == '':
         return jsonify({'error': 'empty filename'}), 400
-    images_dir = Path(app.static_folder) / 'assets' / 'images'
-    images_dir.mkdir(parents=True, exist_ok=True)
-    safe_name = f.filename.replace('..', '_')
-    dest = images_dir / safe_name
-    f.save(dest)
+    # secure_filename strips path separators and dot-segments properly; the
+    # old '..' replace still allowed traversal via separators
+    safe_name = secure_filename(f.filename)
+    if not safe_name:
+        return jsonify({'error': 'invalid filename'}), 400
+    dest = _IMAGES_DIR / safe_name
+    # respond as soon as the body is read; the pool persists it to disk
+    _upload_executor.submit(_write_upload, dest, f.stream.read())
     return jsonify({'url': f"/assets/images/{safe_name}"}), 201
 
 
@@ -499,27 +708,51 @@ def api_debug_dump():
     if not u or u.get('role') != 'admin':
         return jsonify({'error': 'forbidden'}), 403
     try:
-        dump = {
-            'products': db.list_products(),
-            'orders': db.list_orders(),
-            'inventory': db.list_inventory(),
-            'sources': db.list_sources(),
-            'product_sources': db.list_product_sources(),
-            'movements': db.list_movements(limit=1000),
-            'api_logs': db.list_api_logs(limit=1000)
-        }
-        return jsonify(dump)
+        return jsonify(db.bulk_dump())
     except Exception as e:
         return jsonify({'error': 'failed to generate dump', 'detail': str(e)}), 500
 
 
+class _ChunkBuffer:
+    """Minimal unseekable file-like object for streaming a ZIP: ZipFile writes
+    into it and the response generator drains the accumulated chunks."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks = self._chunks
+        self._chunks = []
+        return b''.join(chunks)
+
+
 @app.route('/api/debug/export', methods=['GET'])
+@concurrency_limit(2)
 def api_debug_export():
     """Admin-only: export tables as CSV or a ZIP of CSV files.
 
     Query params:
       table=<name>|all  (e.g., orders, products)
       format=csv|zip     (default csv; if table=all, zip is better)
+
+    Responses are streamed: CSV exports yield rows as they serialize and the
+    all-tables ZIP flushes each table's entry as it is written, so peak memory
+    stays around one table instead of the whole archive.
     """
     u = session.get('user')
     if not u or u.get('role') != 'admin':
@@ -527,58 +760,62 @@ def api_debug_export():
     table = request.args.get('table', 'all')
     fmt = request.args.get('format', 'csv')
 
-    # helper to create CSV string from rows (list of dicts)
     import io, csv, zipfile, datetime
+    from flask import Response, stream_with_context
 
     def rows_to_csv_bytes(rows):
-        out = io.StringIO()
         if not rows:
-            return out.getvalue().encode('utf-8')
-        # use keys of first row as header
-        keys = list(rows[0].keys())
-        writer = csv.writer(out)
-        writer.writerow(keys)
-        for r in rows:
-            writer.writerow([r.get(k, '') for k in keys])
+            return b''
+        out = io.StringIO()
+        # DictWriter.writerows runs the whole row loop in the C _csv module
+        # instead of a per-row per-key Python .get dance
+        writer = csv.DictWriter(out, fieldnames=list(rows[0].keys()), restval='', extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
         return out.getvalue().encode('utf-8')
 
-    try:
-        choices = {
-            'products': db.list_products,
-            'orders': db.list_orders,
-            'inventory': db.list_inventory,
-            'sources': db.list_sources,
-            'product_sources': db.list_product_sources,
-            'movements': lambda: db.list_movements(limit=100000),
-            'api_logs': lambda: db.list_api_logs(limit=100000)
-        }
-        if table != 'all' and table not in choices:
-            return jsonify({'error': 'unknown table'}), 400
-
-        if table == 'all':
-            # package all as zip
-            bio = io.BytesIO()
-            with zipfile.ZipFile(bio, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+    choices = {
+        'products': db.list_products,
+        'orders': db.list_orders,
+        'inventory': db.list_inventory,
+        'sources': db.list_sources,
+        'product_sources': db.list_product_sources,
+        'movements': lambda: db.list_movements(limit=100000),
+        'api_logs': lambda: db.list_api_logs(limit=100000)
+    }
+    if table != 'all' and table not in choices:
+        return jsonify({'error': 'unknown table'}), 400
+
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    if table == 'all':
+        def generate_zip():
+            buf = _ChunkBuffer()
+            with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
                 for name, fn in choices.items():
-                    rows = fn()
-                    data = rows_to_csv_bytes(rows)
-                    zf.writestr(f"{name}.csv", data)
-            bio.seek(0)
-            fname = f"db_export_all_{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.zip"
-            return (bio.getvalue(), 200, {
-                'Content-Type': 'application/zip',
-                'Content-Disposition': f'attachment; filename="{fname}"'
-            })
-        else:
+                    zf.writestr(f"{name}.csv", rows_to_csv_bytes(fn()))
+                    yield buf.drain()
+            yield buf.drain()
+
+        fname = f"db_export_all_{stamp}.zip"
+        return Response(stream_with_context(generate_zip()), mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename="{fname}"'})
+    else:
+        def generate_csv(chunk=500):
             rows = choices[table]()
-            data = rows_to_csv_bytes(rows)
-            fname = f"{table}_{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.csv"
-            return (data, 200, {
-                'Content-Type': 'text/csv; charset=utf-8',
-                'Content-Disposition': f'attachment; filename="{fname}"'
-            })
-    except Exception as e:
-        return jsonify({'error': 'export failed', 'detail': str(e)}), 500
+            if not rows:
+                return
+            out = io.StringIO()
+            writer = csv.DictWriter(out, fieldnames=list(rows[0].keys()), restval='', extrasaction='ignore')
+            writer.writeheader()
+            for start in range(0, len(rows), chunk):
+                writer.writerows(rows[start:start + chunk])
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+
+        fname = f"{table}_{stamp}.csv"
+        return Response(stream_with_context(generate_csv()), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename="{fname}"'})
 
 
 @app.route('/api/daily_summary')
@@ -590,18 +827,47 @@ def api_daily_summary():
     return jsonify(db.daily_summary(date))
 
 
+# /api/images is polled by the SPA; the listing only changes when the images
+# directory does, so cache it keyed on the directory's mtime (one stat per
+# request on the hit path instead of a scandir + per-file stats).
+_IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.gif')
+_images_cache = {'mtime_ns': None, 'payload': None}
+
+
 @app.route('/api/images')
 def api_images():
-    images_dir = Path(app.static_folder) / 'assets' / 'images'
-    out = []
-    if images_dir.exists():
-        for f in sorted(images_dir.iterdir()):
-            if f.is_file() and f.suffix.lower() in ('.jpg', '.jpeg', '.png', '.gif'):
-                out.append(f"/assets/images/{f.name}")
-    return jsonify(out)
+    try:
+        mtime_ns = os.stat(_IMAGES_DIR).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    if mtime_ns is None:
+        out = []
+    elif _images_cache['mtime_ns'] == mtime_ns:
+        out = _images_cache['payload']
+    else:
+        with os.scandir(_IMAGES_DIR) as entries:
+            out = sorted(
+                f"/assets/images/{entry.name}"
+                for entry in entries
+                if entry.is_file() and entry.name.lower().endswith(_IMAGE_EXTS)
+            )
+        _images_cache['mtime_ns'] = mtime_ns
+        _images_cache['payload'] = out
+    etag = f'{mtime_ns or 0:x}'
+    if request.if_none_match.contains(etag):
+        resp = app.make_response(('', 304))
+    else:
+        resp = app.make_response(jsonify(out))
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 
 if __name__ == '__main__':
+    # Development server only. In production run behind gunicorn (see
+    # gunicorn_conf.py / Procfile): gunicorn -c gunicorn_conf.py app:app
+    # The Werkzeug dev server is single-threaded and serializes every request.
     db.init_db()
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    debug = os.environ.get("FLASK_DEBUG", "1") == "1"
+    app.run(host="0.0.0.0", port=port, debug=debug)
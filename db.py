@@ -12,63 +12,420 @@ DB_PATH = os.path.join(os.path.dirname(__file__), "erp.db")  # relative path to
 
 
 from pathlib import Path
+import atexit
+import functools
+import hashlib
+import hmac
+import logging
+import math
+import queue
+import secrets
 import sqlite3
+import threading
+import time
 from datetime import datetime, timezone
 
+log = logging.getLogger(__name__)
 
+
+# (epoch second, formatted string). The stored precision is whole seconds,
+# so within one second every call returns the same string — cache it and
+# skip the datetime allocation/formatting on bursts (audit logging, batches).
+# The unguarded swap is a benign race: worst case two threads format the
+# same second twice.
+_now_cache: tuple = (0, '')
+
+
+def _now_iso() -> str:
+    """Current UTC time as the ISO-8601 'Z' string stored in every table.
+
+    Computed once per transactional helper and passed through, instead of
+    re-allocating and re-formatting a datetime at each statement. Cached
+    per second since that's the stored precision.
+    """
+    global _now_cache
+    sec = int(time.time())
+    cached = _now_cache
+    if cached[0] != sec:
+        cached = (sec, datetime.fromtimestamp(sec, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S') + 'Z')
+        _now_cache = cached
+    return cached[1]
+
+
+def _bottles_for(quantity: float) -> int:
+    """Number of bottles a sale of `quantity` units consumes (whole bottles)."""
+    return math.ceil(quantity)
+
+
+def _prefix_bounds(prefix: str) -> tuple:
+    """Half-open [lo, hi) bounds equivalent to ``LIKE prefix || '%'``.
+
+    A prefix LIKE forces a scan; the same match expressed as a range lets
+    SQLite use an index on the column. Works for any prefix (full dates,
+    'YYYY-MM', ...) since stored timestamps are plain ASCII.
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+@functools.lru_cache(maxsize=None)
 def get_db_path(base_dir: Path = Path(__file__).parent / "data") -> Path:
+    # memoized: the mkdir (a stat syscall per call once the directory exists)
+    # runs only the first time a given base_dir is seen
     base_dir.mkdir(parents=True, exist_ok=True)
     return base_dir / "erp.db"
 
 
+# Connections are cached per thread and per database path: reopening erp.db
+# (plus its -wal/-shm files) for every helper call costs file opens, pragma
+# setup and a cold page cache each time. Helpers therefore no longer close
+# the connection they get from connect(); the cache owns its lifetime.
+_conn_local = threading.local()
+_all_conns: list = []
+_all_conns_lock = threading.Lock()
+
+# bump when init_db gains a new migration or changes the index layout;
+# databases stamped with the current version skip the whole init path
+# (DDL, migration probes, seeding, index DDL, ANALYZE) at startup.
+# 4: composite sales/movements indexes replacing the single-column ones
+_SCHEMA_VERSION = 4
+
+# SQL-side timestamp: fills last_updated/timestamp columns in SQLite's C
+# path instead of allocating and formatting a Python datetime per write.
+# Inlined as an expression (not a DDL default) so it also covers rows written
+# to databases created before any schema change.
+_SQL_NOW = "strftime('%Y-%m-%dT%H:%M:%fZ','now')"
+
+# RETURNING (SQLite 3.35+) lets write helpers hand back the affected row
+# without a follow-up SELECT; older library builds keep the two-statement path
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# hot statements as module constants: the same (interned) SQL string hits the
+# connection's statement cache every call instead of being re-prepared
+_SQL_SELECT_SOURCE_QTY = "SELECT quantity FROM sources WHERE id = ?"
+_SQL_UPDATE_SOURCE_QTY = "UPDATE sources SET quantity = ?, last_updated = ? WHERE id = ?"
+_SQL_SELECT_INVENTORY_QTY = "SELECT quantity FROM inventory WHERE product_id = ?"
+_SQL_UPDATE_INVENTORY_QTY = "UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?"
+_SQL_INSERT_INVENTORY = "INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)"
+_SQL_INSERT_MOVEMENT = "INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)"
+_SQL_INSERT_API_LOG = "INSERT INTO api_logs (timestamp, user_id, method, path, payload, status, duration_ms, ip) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+# In-process caches of the tiny products / product_sources tables, keyed the
+# same way as the connection cache (str of the database path). record_order
+# reads them instead of re-SELECTing per sale; every helper that edits either
+# table clears them, and a miss reloads from the database. Writes from other
+# processes (gunicorn workers) can't trigger that invalidation, so the cache
+# is additionally revalidated against PRAGMA data_version, which bumps
+# whenever any other connection commits to the database.
+_product_cache: dict = {}          # key -> {product_id: (name, unit_price)}
+_product_source_cache: dict = {}   # key -> {product_id: (source_id, factor)}
+# data_version is connection-local, so the last-seen value is tracked per
+# (key, thread): each thread compares against its own connection's counter
+_product_cache_dv: dict = {}       # (key, thread ident) -> data_version
+_product_cache_lock = threading.Lock()
+
+# sales column set per database, cached because the schema only changes in
+# init_db's migrations (which clear this); saves a PRAGMA table_info round
+# trip per sale / listing call
+_sales_cols_cache: dict = {}       # key -> tuple of column names
+
+
+def _cache_key(db_path: Path | str | None) -> str:
+    return str(db_path) if db_path is not None else str(get_db_path())
+
+
+def _sales_cols(cur, key: str):
+    cols = _sales_cols_cache.get(key)
+    if cols is None:
+        cur.execute("PRAGMA table_info(sales)")
+        cols = tuple(c[1] for c in cur.fetchall())
+        _sales_cols_cache[key] = cols
+    return cols
+
+
+# optional sales columns in the order they were added over time
+_SALES_OPTIONAL_COLS = ('created_by', 'bottles_used', 'bottle_price', 'client_timestamp')
+
+# per-database specialization of record_order's INSERT and post-insert
+# SELECT: the SQL text is constant once the column set is known, so build it
+# once instead of joining field lists per sale
+_sales_sql_cache: dict = {}        # key -> (fields, insert_sql, select_sql)
+
+
+def _sales_sql(cur, key: str):
+    entry = _sales_sql_cache.get(key)
+    if entry is None:
+        cols = _sales_cols(cur, key)
+        fields = ['product_id', 'quantity', 'unit_price', 'total', 'payment_method', 'timestamp']
+        fields += [c for c in _SALES_OPTIONAL_COLS if c in cols]
+        insert_sql = f"INSERT INTO sales ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})"
+        select_cols = ['s.id', 's.product_id', 'p.name as product_name', 's.quantity', 's.unit_price', 's.total', 's.payment_method', 's.timestamp']
+        select_cols += [f's.{c}' for c in _SALES_OPTIONAL_COLS if c in cols]
+        select_sql = f"SELECT {', '.join(select_cols)} FROM sales s JOIN products p ON p.id = s.product_id WHERE s.id = ?"
+        entry = (tuple(fields), insert_sql, select_sql)
+        _sales_sql_cache[key] = entry
+    return entry
+
+
+# (cache key, bottle-size factor or None) -> bottle product id (or None when
+# no such product exists). The id is stable, so the name lookup that used to
+# run on every bottle sale happens once per process and size.
+_bottle_pid_cache: dict = {}
+
+
+def _invalidate_product_caches():
+    with _product_cache_lock:
+        _product_cache.clear()
+        _product_source_cache.clear()
+        _product_cache_dv.clear()
+        _bottle_pid_cache.clear()
+
+
+def _bottle_pid(cur, key: str, factor: float | None):
+    """Product id of the empty-bottle product for the given size factor.
+
+    Prefers the size-specific 'Empty NL bottle' name, falls back to any
+    product containing 'Empty'. Memoized per database and size; cleared with
+    the other product caches whenever products change.
+    """
+    cache_key = (key, factor)
+    if cache_key in _bottle_pid_cache:
+        return _bottle_pid_cache[cache_key]
+    pid = None
+    try:
+        if factor is not None:
+            cur.execute("SELECT id FROM products WHERE name = ?", (f"Empty {int(factor)}L bottle",))
+            prow = cur.fetchone()
+            if prow:
+                pid = prow[0]
+        if pid is None:
+            cur.execute("SELECT id FROM products WHERE name LIKE ?", ("%Empty%",))
+            prow = cur.fetchone()
+            if prow:
+                pid = prow[0]
+    except Exception:
+        pid = None
+    _bottle_pid_cache[cache_key] = pid
+    return pid
+
+
+def _product_maps(conn, key: str):
+    """Return ({id: (name, unit_price)}, {id: (source_id, factor)}) for key."""
+    cur = conn.cursor()
+    cur.row_factory = None
+    # revalidate before serving cached prices: data_version changes when any
+    # other connection (thread or worker process) has committed, so a price
+    # edit handled elsewhere forces a reload instead of charging stale prices
+    cur.execute("PRAGMA data_version")
+    dv = cur.fetchone()[0]
+    dv_key = (key, threading.get_ident())
+    with _product_cache_lock:
+        products = _product_cache.get(key)
+        mappings = _product_source_cache.get(key)
+        if _product_cache_dv.get(dv_key) != dv:
+            products = mappings = None
+    if products is None or mappings is None:
+        products = {pid: (name, price) for pid, name, price in cur.execute("SELECT id, name, unit_price FROM products")}
+        mappings = {pid: (sid, factor) for pid, sid, factor in cur.execute("SELECT product_id, source_id, factor FROM product_sources")}
+        with _product_cache_lock:
+            _product_cache[key] = products
+            _product_source_cache[key] = mappings
+            _product_cache_dv[dv_key] = dv
+    return products, mappings
+
+
+# column tuples for the bulk list helpers. Those fetch plain tuples (the
+# cursor's row_factory is reset) and build dicts with zip against these
+# pre-interned keys, which is cheaper per row than dict(sqlite3.Row).
+_SOURCE_COLS = ('id', 'name', 'unit', 'quantity', 'last_updated')
+_PRODUCT_COLS = ('id', 'name', 'unit_price')
+_INVENTORY_COLS = ('id', 'product_id', 'product_name', 'quantity', 'last_updated')
+_PRODUCT_SOURCE_COLS = ('product_id', 'source_id', 'factor', 'product_name', 'source_name')
+_PRICE_HISTORY_COLS = ('id', 'product_id', 'old_price', 'new_price', 'changed_by', 'timestamp', 'reason')
+_MOVEMENT_COLS = ('id', 'kind', 'ref_id', 'delta', 'reason', 'timestamp', 'user_id')
+_API_LOG_COLS = ('id', 'timestamp', 'user_id', 'method', 'path', 'payload', 'status', 'duration_ms', 'ip')
+
+# full table DDL, handed to SQLite's parser in one executescript call from
+# init_db instead of a cur.execute per table
+_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    unit_price REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sales (
+    id INTEGER PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    quantity REAL NOT NULL,
+    unit_price REAL NOT NULL,
+    total REAL NOT NULL,
+    payment_method TEXT DEFAULT 'Cash',
+    timestamp TEXT NOT NULL,
+    created_by INTEGER,
+    FOREIGN KEY(product_id) REFERENCES products(id),
+    FOREIGN KEY(created_by) REFERENCES users(id)
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    role TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS inventory (
+    id INTEGER PRIMARY KEY,
+    product_id INTEGER UNIQUE NOT NULL,
+    quantity REAL NOT NULL DEFAULT 0,
+    last_updated TEXT NOT NULL,
+    FOREIGN KEY(product_id) REFERENCES products(id)
+);
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    unit TEXT NOT NULL DEFAULT 'L',
+    quantity REAL NOT NULL DEFAULT 0,
+    last_updated TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS product_sources (
+    product_id INTEGER PRIMARY KEY,
+    source_id INTEGER NOT NULL,
+    factor REAL NOT NULL DEFAULT 1,
+    FOREIGN KEY(product_id) REFERENCES products(id),
+    FOREIGN KEY(source_id) REFERENCES sources(id)
+);
+CREATE TABLE IF NOT EXISTS movements (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    ref_id INTEGER,
+    delta REAL NOT NULL,
+    reason TEXT,
+    timestamp TEXT NOT NULL,
+    user_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS api_logs (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    user_id INTEGER,
+    method TEXT NOT NULL,
+    path TEXT NOT NULL,
+    payload TEXT,
+    status INTEGER,
+    duration_ms INTEGER,
+    ip TEXT
+);
+CREATE TABLE IF NOT EXISTS price_history (
+    id INTEGER PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    old_price REAL,
+    new_price REAL NOT NULL,
+    changed_by INTEGER,
+    reason TEXT,
+    timestamp TEXT NOT NULL
+);
+"""
+
+# kept separate from _SCHEMA_SQL: indexes are (re)created after the sales
+# migrations so a rebuilt sales table gets them back in the same init run
+_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_products_name ON products(name);
+DROP INDEX IF EXISTS idx_sales_ts;
+CREATE INDEX IF NOT EXISTS idx_sales_ts_user ON sales(timestamp, created_by, id DESC);
+CREATE INDEX IF NOT EXISTS idx_sales_created_by_id ON sales(created_by, id DESC);
+CREATE INDEX IF NOT EXISTS idx_sales_pid_ts ON sales(product_id, timestamp);
+DROP INDEX IF EXISTS idx_movements_kind_ref;
+CREATE INDEX IF NOT EXISTS idx_movements_kind_ref_id ON movements(kind, ref_id, id DESC);
+CREATE INDEX IF NOT EXISTS idx_api_logs_ts ON api_logs(timestamp);
+CREATE INDEX IF NOT EXISTS idx_product_sources_sid ON product_sources(source_id);
+"""
+
+
+def _new_connection(path: str):
+    # check_same_thread=False only so the atexit cleanup below may close
+    # connections created by other threads; each thread still uses its own.
+    # a larger statement cache keeps the hot helpers' SQL compiled across calls
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    if path != ':memory:':
+        # WAL lets dashboard reads run while a sale commits, and NORMAL
+        # drops the extra fsync per commit (safe in WAL: a crash can lose
+        # the last transactions but never corrupts the database).
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")  # 20 MB page cache
+        conn.execute("PRAGMA mmap_size=268435456")
+        # note: foreign_keys stays at SQLite's default (OFF) — the delete and
+        # stock helpers rely on being able to remove/point at rows without
+        # cascading checks, matching the original schema's behavior
+        conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
 def connect(db_path: Path | str | None = None):
+    """Return this thread's cached connection for db_path (opened lazily).
+
+    Callers must not close the returned connection; if outside code does
+    anyway, the next connect() detects the dead handle and reopens.
+    """
     if db_path is None:
         db_path = get_db_path()
-    conn = sqlite3.connect(str(db_path))
-    conn.row_factory = sqlite3.Row
+    key = str(db_path)
+    cache = getattr(_conn_local, 'conns', None)
+    if cache is None:
+        cache = _conn_local.conns = {}
+    conn = cache.get(key)
+    if conn is not None:
+        try:
+            conn.total_changes  # cheap liveness probe; raises once closed
+        except sqlite3.ProgrammingError:
+            pass
+        else:
+            # a write helper that failed between execute and commit leaves
+            # the cached connection mid-transaction; clear it here so the
+            # next caller doesn't hit "cannot start a transaction within a
+            # transaction" (or silently commit the leftover statements)
+            if conn.in_transaction:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            return conn
+    conn = _new_connection(key)
+    cache[key] = conn
+    with _all_conns_lock:
+        _all_conns.append(conn)
     return conn
 
 
+@atexit.register
+def _close_connections():
+    with _all_conns_lock:
+        conns, _all_conns[:] = list(_all_conns), []
+    for conn in conns:
+        try:
+            # keep sqlite_stat1 fresh so the planner has row-count estimates
+            # for the joins next process start
+            conn.execute("PRAGMA optimize")
+            conn.close()
+        except Exception:
+            pass
+
+
 def init_db(db_path: Path | str | None = None):
     """Create tables and add default product (5L water at 40 KSH) if missing."""
     conn = connect(db_path)
     cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY,
-            name TEXT NOT NULL,
-            unit_price REAL NOT NULL
-        )
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS sales (
-            id INTEGER PRIMARY KEY,
-            product_id INTEGER NOT NULL,
-            quantity REAL NOT NULL,
-            unit_price REAL NOT NULL,
-            total REAL NOT NULL,
-            payment_method TEXT DEFAULT 'Cash',
-            timestamp TEXT NOT NULL,
-            created_by INTEGER,
-            FOREIGN KEY(product_id) REFERENCES products(id),
-            FOREIGN KEY(created_by) REFERENCES users(id)
-        )
-        """
-    )
-    # create users table for simple auth
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            role TEXT NOT NULL
-        )
-        """
-    )
+    # a database stamped with the current schema version has already been
+    # through the whole init path (tables, migrations, seeds, indexes, stats):
+    # short-circuit so a routine process start costs one PRAGMA read
+    cur.execute("PRAGMA user_version")
+    user_version = cur.fetchone()[0]
+    if user_version == _SCHEMA_VERSION:
+        return
+    # all table DDL goes through one executescript call (runs in autocommit,
+    # before the seed transaction below)
+    conn.executescript(_SCHEMA_SQL)
+    # one transaction for the migration + seed path: a single fsync instead
+    # of one per seed commit
+    cur.execute("BEGIN IMMEDIATE")
     # ensure default product exists
     cur.execute("SELECT id FROM products WHERE name = ?", ("5L water",))
     if cur.fetchone() is None:
@@ -76,107 +433,20 @@ def init_db(db_path: Path | str | None = None):
     # ensure default users
     cur.execute("SELECT id FROM users WHERE username = ?", ("admin",))
     if cur.fetchone() is None:
-        # NOTE: passwords stored in plain text for prototype only
-        cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", ("admin", "admin", "admin"))
+        cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", ("admin", hash_password("admin"), "admin"))
     cur.execute("SELECT id FROM users WHERE username = ?", ("user",))
     if cur.fetchone() is None:
-        cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", ("user", "user", "user"))
-    conn.commit()
-    # ensure inventory table exists (tracks product stock levels)
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS inventory (
-            id INTEGER PRIMARY KEY,
-            product_id INTEGER UNIQUE NOT NULL,
-            quantity REAL NOT NULL DEFAULT 0,
-            last_updated TEXT NOT NULL,
-            FOREIGN KEY(product_id) REFERENCES products(id)
-        )
-        """
-    )
-    # ensure sources table exists (central tanks / gallons where water comes from)
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS sources (
-            id INTEGER PRIMARY KEY,
-            name TEXT NOT NULL,
-            unit TEXT NOT NULL DEFAULT 'L',
-            quantity REAL NOT NULL DEFAULT 0,
-            last_updated TEXT NOT NULL
-        )
-        """
-    )
-    # mapping from product to source with factor (litres consumed per product unit)
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS product_sources (
-            product_id INTEGER PRIMARY KEY,
-            source_id INTEGER NOT NULL,
-            factor REAL NOT NULL DEFAULT 1,
-            FOREIGN KEY(product_id) REFERENCES products(id),
-            FOREIGN KEY(source_id) REFERENCES sources(id)
-        )
-        """
-    )
-    # audit movements table for sources and inventory adjustments
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS movements (
-            id INTEGER PRIMARY KEY,
-            kind TEXT NOT NULL,
-            ref_id INTEGER,
-            delta REAL NOT NULL,
-            reason TEXT,
-            timestamp TEXT NOT NULL,
-            user_id INTEGER
-        )
-        """
-    )
-    # API logs: records request metadata for auditing
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS api_logs (
-            id INTEGER PRIMARY KEY,
-            timestamp TEXT NOT NULL,
-            user_id INTEGER,
-            method TEXT NOT NULL,
-            path TEXT NOT NULL,
-            payload TEXT,
-            status INTEGER,
-            duration_ms INTEGER,
-            ip TEXT
-        )
-        """
-    )
-
-    # price history for products (records price changes)
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS price_history (
-            id INTEGER PRIMARY KEY,
-            product_id INTEGER NOT NULL,
-            old_price REAL,
-            new_price REAL NOT NULL,
-            changed_by INTEGER,
-            reason TEXT,
-            timestamp TEXT NOT NULL
-        )
-        """
-    )
-    # Ensure sales.quantity is REAL (migrate if older INTEGER existed)
-    try:
-        cur.execute("PRAGMA table_info(sales)")
-        cols = cur.fetchall()
-        qty_col = None
-        for c in cols:
-            # c is sqlite3.Row with name and type
-            if c[1] == 'quantity':
-                qty_col = c
-                break
-        if qty_col is not None:
-            col_type = qty_col[2].upper() if qty_col[2] else ''
-            if col_type != 'REAL':
-                # migrate table: create new table with quantity REAL, copy data
+        cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", ("user", hash_password("user"), "user"))
+    # sales-table migrations; the version is stamped at the very end of
+    # init_db (after the index DDL) so a failure anywhere leaves the database
+    # unstamped and the next start retries the whole path
+    stamp_version = False
+    if user_version < _SCHEMA_VERSION:
+        try:
+            cur.execute("PRAGMA table_info(sales)")
+            cols = {c[1]: (c[2].upper() if c[2] else '') for c in cur.fetchall()}
+            # quantity was INTEGER in very old databases; rebuild with REAL
+            if cols.get('quantity', 'REAL') != 'REAL':
                 cur.execute('ALTER TABLE sales RENAME TO sales_old')
                 cur.execute(
                     """
@@ -192,52 +462,27 @@ def init_db(db_path: Path | str | None = None):
                     )
                     """
                 )
-                # copy rows, casting quantity to REAL
                 cur.execute("INSERT INTO sales (id, product_id, quantity, unit_price, total, payment_method, timestamp) SELECT id, product_id, CAST(quantity AS REAL), unit_price, total, payment_method, timestamp FROM sales_old")
                 cur.execute("DROP TABLE sales_old")
-                conn.commit()
-    except Exception:
-        # if anything goes wrong, ignore migration (keep running)
-        pass
-    # ensure created_by column exists (add if missing)
-    try:
-        cur.execute("PRAGMA table_info(sales)")
-        cols = [c[1] for c in cur.fetchall()]
-        if 'created_by' not in cols:
-            cur.execute("ALTER TABLE sales ADD COLUMN created_by INTEGER")
-            conn.commit()
-    except Exception:
-        pass
-    # ensure bottles_used column exists (track number of bottles consumed by a sale)
-    try:
-        cur.execute("PRAGMA table_info(sales)")
-        cols = [c[1] for c in cur.fetchall()]
-        if 'bottles_used' not in cols:
-            cur.execute("ALTER TABLE sales ADD COLUMN bottles_used INTEGER DEFAULT 0")
-            conn.commit()
-    except Exception:
-        pass
-    # ensure bottle_price column exists (track price of bottles when used)
-    try:
-        cur.execute("PRAGMA table_info(sales)")
-        cols = [c[1] for c in cur.fetchall()]
-        if 'bottle_price' not in cols:
-            cur.execute("ALTER TABLE sales ADD COLUMN bottle_price REAL DEFAULT 0")
-            conn.commit()
-    except Exception:
-        pass
-    # ensure client_timestamp column exists (store device/system timestamp for orders)
-    try:
-        cur.execute("PRAGMA table_info(sales)")
-        cols = [c[1] for c in cur.fetchall()]
-        if 'client_timestamp' not in cols:
-            cur.execute("ALTER TABLE sales ADD COLUMN client_timestamp TEXT")
-            conn.commit()
-    except Exception:
-        pass
+                # the rebuilt table has none of the optional columns
+                cols = {c: '' for c in ('id', 'product_id', 'quantity', 'unit_price', 'total', 'payment_method', 'timestamp')}
+            # optional columns added over time
+            for col, ddl in (
+                ("created_by", "INTEGER"),
+                ("bottles_used", "INTEGER DEFAULT 0"),
+                ("bottle_price", "REAL DEFAULT 0"),
+                ("client_timestamp", "TEXT"),
+            ):
+                if col not in cols:
+                    cur.execute(f"ALTER TABLE sales ADD COLUMN {col} {ddl}")
+            stamp_version = True
+        except Exception:
+            # if anything goes wrong, skip migration (keep running); the
+            # version stays unstamped so the next start retries
+            pass
     # --- Seed default sources and bottle stock ---
     try:
-        now = datetime.utcnow().isoformat() + 'Z'
+        now = _now_iso()
         # ensure main tank (10000 L)
         cur.execute("SELECT id FROM sources WHERE name = ?", ("Main Tank",))
         r = cur.fetchone()
@@ -247,67 +492,77 @@ def init_db(db_path: Path | str | None = None):
         else:
             main_tank_id = r[0]
 
-        # ensure water products exist (5L, 10L, 20L)
-        cur.execute("SELECT id FROM products WHERE name = ?", ("5L water",))
-        if cur.fetchone() is None:
-            cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", ("5L water", 40.0))
-        cur.execute("SELECT id FROM products WHERE name = ?", ("10L water",))
-        if cur.fetchone() is None:
-            cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", ("10L water", 70.0))
-        cur.execute("SELECT id FROM products WHERE name = ?", ("20L water",))
-        if cur.fetchone() is None:
-            cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", ("20L water", 120.0))
-
-        # ensure empty bottle product types and inventory counts
-        bottle_templates = [
-            ("Empty 5L bottle", 0.0, 120.0),
-            ("Empty 10L bottle", 0.0, 80.0),
-            ("Empty 20L bottle", 0.0, 40.0),
+        # seed default products (water sizes + empty bottles) in one batch.
+        # products.name has no UNIQUE constraint, so compute the missing set
+        # with one SELECT instead of relying on INSERT OR IGNORE.
+        product_seed = [
+            ("5L water", 40.0),
+            ("10L water", 70.0),
+            ("20L water", 120.0),
+            ("Empty 5L bottle", 0.0),
+            ("Empty 10L bottle", 0.0),
+            ("Empty 20L bottle", 0.0),
         ]
-        for name, price, initial_count in bottle_templates:
-            cur.execute("SELECT id FROM products WHERE name = ?", (name,))
-            r = cur.fetchone()
-            if r is None:
-                cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", (name, float(price)))
-                pid = cur.lastrowid
-            else:
-                pid = r[0]
-            # upsert inventory row for bottle counts
-            cur.execute("SELECT id FROM inventory WHERE product_id = ?", (pid,))
-            inv = cur.fetchone()
-            if inv is None:
-                cur.execute("INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (pid, float(initial_count), now))
-            else:
-                cur.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?", (float(initial_count), now, pid))
+        names = tuple(n for n, _ in product_seed)
+        placeholders = ", ".join("?" * len(names))
+        cur.execute(f"SELECT name FROM products WHERE name IN ({placeholders})", names)
+        existing = {r[0] for r in cur.fetchall()}
+        cur.executemany(
+            "INSERT INTO products (name, unit_price) VALUES (?, ?)",
+            [row for row in product_seed if row[0] not in existing])
+        # one lookup for every seeded id
+        cur.execute(f"SELECT name, id FROM products WHERE name IN ({placeholders})", names)
+        ids = {r[0]: r[1] for r in cur.fetchall()}
+
+        # initial bottle counts; OR IGNORE keeps whatever stock is already on hand
+        bottle_counts = [
+            ("Empty 5L bottle", 120.0),
+            ("Empty 10L bottle", 80.0),
+            ("Empty 20L bottle", 40.0),
+        ]
+        cur.executemany(
+            "INSERT OR IGNORE INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)",
+            [(ids[n], count, now) for n, count in bottle_counts if n in ids])
 
-        # map water products to main tank with factors (litres per unit)
+        # map water products to main tank with factors (litres per unit);
+        # OR IGNORE preserves mappings the operator has customised
         mappings = [("5L water", 5.0), ("10L water", 10.0), ("20L water", 20.0)]
-        for pname, factor in mappings:
-            cur.execute("SELECT id FROM products WHERE name = ?", (pname,))
-            r = cur.fetchone()
-            if r:
-                pid = r[0]
-                cur.execute("SELECT product_id FROM product_sources WHERE product_id = ?", (pid,))
-                if cur.fetchone() is None:
-                    cur.execute("INSERT INTO product_sources (product_id, source_id, factor) VALUES (?, ?, ?)", (pid, main_tank_id, float(factor)))
-                else:
-                    cur.execute("UPDATE product_sources SET source_id = ?, factor = ? WHERE product_id = ?", (main_tank_id, float(factor), pid))
+        cur.executemany(
+            "INSERT OR IGNORE INTO product_sources (product_id, source_id, factor) VALUES (?, ?, ?)",
+            [(ids[n], main_tank_id, factor) for n, factor in mappings if n in ids])
 
-        conn.commit()
     except Exception:
         # non-fatal; continue
         pass
-    conn.close()
+    conn.commit()
+    # seeding may have added products/mappings after a cache was warmed,
+    # and the migrations above may have added sales columns
+    _invalidate_product_caches()
+    _sales_cols_cache.clear()
+    _sales_sql_cache.clear()
+    _list_sql_cache.clear()
+    # indexes for the hot joins and lookups (name lookups in seeding, sales
+    # listings/summaries by timestamp, movements audit scans); created after
+    # the migrations so a rebuilt sales table gets them back immediately.
+    # inventory.product_id is already UNIQUE so it has an implicit index.
+    conn.executescript(_INDEX_SQL)
+    # populate sqlite_stat1 so the query planner starts with real estimates
+    try:
+        cur.execute("ANALYZE")
+    except Exception:
+        pass
+    # certify the database so the next init_db call short-circuits entirely
+    if stamp_version:
+        cur.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
 
 
 ### Sources (central tanks) helpers ###
 def list_sources(db_path: Path | str | None = None):
     conn = connect(db_path)
     cur = conn.cursor()
+    cur.row_factory = None
     cur.execute("SELECT id, name, unit, quantity, last_updated FROM sources ORDER BY id")
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return [dict(zip(_SOURCE_COLS, row)) for row in cur.fetchall()]
 
 
 def get_source(source_id: int, db_path: Path | str | None = None):
@@ -315,45 +570,47 @@ def get_source(source_id: int, db_path: Path | str | None = None):
     cur = conn.cursor()
     cur.execute("SELECT id, name, unit, quantity, last_updated FROM sources WHERE id = ?", (source_id,))
     r = cur.fetchone()
-    conn.close()
     return dict(r) if r else None
 
 
 def add_source(name: str, unit: str = 'L', quantity: float = 0, db_path: Path | str | None = None):
-    now = datetime.utcnow().isoformat() + 'Z'
     conn = connect(db_path)
     cur = conn.cursor()
-    cur.execute("INSERT INTO sources (name, unit, quantity, last_updated) VALUES (?, ?, ?, ?)", (name, unit, float(quantity), now))
-    sid = cur.lastrowid
+    if _HAS_RETURNING:
+        cur.execute(
+            f"INSERT INTO sources (name, unit, quantity, last_updated) VALUES (?, ?, ?, {_SQL_NOW}) "
+            "RETURNING id, name, unit, quantity, last_updated",
+            (name, unit, float(quantity)))
+        row = cur.fetchone()
+    else:
+        cur.execute(f"INSERT INTO sources (name, unit, quantity, last_updated) VALUES (?, ?, ?, {_SQL_NOW})", (name, unit, float(quantity)))
+        cur.execute("SELECT id, name, unit, quantity, last_updated FROM sources WHERE id = ?", (cur.lastrowid,))
+        row = cur.fetchone()
     conn.commit()
-    cur.execute("SELECT id, name, unit, quantity, last_updated FROM sources WHERE id = ?", (sid,))
-    row = cur.fetchone()
-    conn.close()
     return dict(row)
 
 
 def update_source(source_id: int, name: str | None = None, unit: str | None = None, quantity: float | None = None, db_path: Path | str | None = None):
     conn = connect(db_path)
     cur = conn.cursor()
-    # build update pieces
-    parts = []
-    params = []
-    if name is not None:
-        parts.append('name = ?'); params.append(name)
-    if unit is not None:
-        parts.append('unit = ?'); params.append(unit)
-    if quantity is not None:
-        parts.append('quantity = ?'); params.append(float(quantity))
-    if not parts:
-        conn.close(); return get_source(source_id, db_path)
-    parts.append('last_updated = ?'); params.append(datetime.utcnow().isoformat() + 'Z')
-    params.append(source_id)
-    sql = f"UPDATE sources SET {', '.join(parts)} WHERE id = ?"
-    cur.execute(sql, tuple(params))
+    if name is None and unit is None and quantity is None:
+        return get_source(source_id, db_path)
+    # fixed-shape UPDATE (COALESCE keeps the current value for absent fields)
+    # so SQLite reuses one cached plan instead of compiling a new f-string
+    params = (name, unit, float(quantity) if quantity is not None else None, source_id)
+    if _HAS_RETURNING:
+        cur.execute(
+            f"UPDATE sources SET name = COALESCE(?, name), unit = COALESCE(?, unit), quantity = COALESCE(?, quantity), last_updated = {_SQL_NOW} WHERE id = ? "
+            "RETURNING id, name, unit, quantity, last_updated",
+            params)
+        row = cur.fetchone()
+    else:
+        cur.execute(
+            f"UPDATE sources SET name = COALESCE(?, name), unit = COALESCE(?, unit), quantity = COALESCE(?, quantity), last_updated = {_SQL_NOW} WHERE id = ?",
+            params)
+        cur.execute("SELECT id, name, unit, quantity, last_updated FROM sources WHERE id = ?", (source_id,))
+        row = cur.fetchone()
     conn.commit()
-    cur.execute("SELECT id, name, unit, quantity, last_updated FROM sources WHERE id = ?", (source_id,))
-    row = cur.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 
@@ -363,7 +620,6 @@ def delete_source(source_id: int, db_path: Path | str | None = None) -> bool:
     cur.execute("DELETE FROM sources WHERE id = ?", (source_id,))
     changed = cur.rowcount
     conn.commit()
-    conn.close()
     return bool(changed)
 
 
@@ -371,37 +627,38 @@ def adjust_source_quantity(source_id: int, delta: float, db_path: Path | str | N
     """Adjust source quantity by delta (can be negative). Returns new quantity. Raises ValueError on insufficient."""
     conn = connect(db_path)
     cur = conn.cursor()
-    cur.execute("SELECT quantity FROM sources WHERE id = ?", (source_id,))
-    r = cur.fetchone()
-    if r is None:
-        if delta < 0:
-            conn.close(); raise ValueError('insufficient stock')
-        new_q = float(delta)
-        now = datetime.utcnow().isoformat() + 'Z'
-        cur.execute("INSERT INTO sources (id, name, unit, quantity, last_updated) VALUES (?, ?, ?, ?, ?)", (source_id, 'source', 'L', new_q, now))
-        conn.commit(); conn.close(); return new_q
-    cur_q = float(r[0])
-    new_q = cur_q + float(delta)
-    if new_q < 0:
-        conn.close(); raise ValueError('insufficient stock')
-    now = datetime.utcnow().isoformat() + 'Z'
-    cur.execute("UPDATE sources SET quantity = ?, last_updated = ? WHERE id = ?", (new_q, now, source_id))
-    conn.commit(); conn.close(); return new_q
+    delta = float(delta)
+    if delta >= 0:
+        cur.execute(
+            f"INSERT INTO sources (id, name, unit, quantity, last_updated) VALUES (?, 'source', 'L', 0, {_SQL_NOW}) "
+            "ON CONFLICT(id) DO NOTHING",
+            (source_id,))
+    cur.execute(
+        f"UPDATE sources SET quantity = quantity + ?, last_updated = {_SQL_NOW} WHERE id = ? AND quantity + ? >= 0",
+        (delta, source_id, delta))
+    if cur.rowcount == 0:
+        conn.rollback()
+        raise ValueError('insufficient stock')
+    conn.commit()
+    cur.execute(_SQL_SELECT_SOURCE_QTY, (source_id,))
+    return float(cur.fetchone()[0])
 
 
 ### Product -> Source mapping helpers ###
 def set_product_source(product_id: int, source_id: int, factor: float = 1.0, db_path: Path | str | None = None):
     conn = connect(db_path)
     cur = conn.cursor()
-    cur.execute("SELECT product_id FROM product_sources WHERE product_id = ?", (product_id,))
-    if cur.fetchone() is None:
-        cur.execute("INSERT INTO product_sources (product_id, source_id, factor) VALUES (?, ?, ?)", (product_id, source_id, float(factor)))
+    sql = ("INSERT INTO product_sources (product_id, source_id, factor) VALUES (?, ?, ?) "
+           "ON CONFLICT(product_id) DO UPDATE SET source_id = excluded.source_id, factor = excluded.factor")
+    if _HAS_RETURNING:
+        cur.execute(sql + " RETURNING product_id, source_id, factor", (product_id, source_id, float(factor)))
+        row = cur.fetchone()
     else:
-        cur.execute("UPDATE product_sources SET source_id = ?, factor = ? WHERE product_id = ?", (source_id, float(factor), product_id))
+        cur.execute(sql, (product_id, source_id, float(factor)))
+        cur.execute("SELECT product_id, source_id, factor FROM product_sources WHERE product_id = ?", (product_id,))
+        row = cur.fetchone()
     conn.commit()
-    cur.execute("SELECT product_id, source_id, factor FROM product_sources WHERE product_id = ?", (product_id,))
-    row = cur.fetchone()
-    conn.close()
+    _invalidate_product_caches()
     return dict(row) if row else None
 
 
@@ -410,29 +667,26 @@ def get_product_source(product_id: int, db_path: Path | str | None = None):
     cur = conn.cursor()
     cur.execute("SELECT product_id, source_id, factor FROM product_sources WHERE product_id = ?", (product_id,))
     r = cur.fetchone()
-    conn.close()
     return dict(r) if r else None
 
 
 def list_product_sources(db_path: Path | str | None = None):
     conn = connect(db_path)
     cur = conn.cursor()
+    cur.row_factory = None
     cur.execute("SELECT ps.product_id, ps.source_id, ps.factor, p.name as product_name, s.name as source_name FROM product_sources ps JOIN products p ON p.id = ps.product_id JOIN sources s ON s.id = ps.source_id ORDER BY p.name")
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return [dict(zip(_PRODUCT_SOURCE_COLS, row)) for row in cur.fetchall()]
 
 
 ### Inventory helpers ###
 def list_inventory(db_path: Path | str | None = None):
     conn = connect(db_path)
     cur = conn.cursor()
+    cur.row_factory = None
     cur.execute(
         "SELECT i.id, i.product_id, p.name as product_name, i.quantity, i.last_updated FROM inventory i JOIN products p ON p.id = i.product_id ORDER BY p.name"
     )
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return [dict(zip(_INVENTORY_COLS, row)) for row in cur.fetchall()]
 
 
 def get_inventory_for_product(product_id: int, db_path: Path | str | None = None):
@@ -440,28 +694,23 @@ def get_inventory_for_product(product_id: int, db_path: Path | str | None = None
     cur = conn.cursor()
     cur.execute("SELECT id, product_id, quantity, last_updated FROM inventory WHERE product_id = ?", (product_id,))
     r = cur.fetchone()
-    conn.close()
     return dict(r) if r else None
 
 
 def set_inventory(product_id: int, quantity: float, db_path: Path | str | None = None):
     """Create or update inventory record for a product. Returns the inventory row."""
-    now = datetime.utcnow().isoformat() + 'Z'
     conn = connect(db_path)
     cur = conn.cursor()
-    cur.execute("SELECT id FROM inventory WHERE product_id = ?", (product_id,))
-    if cur.fetchone() is None:
-        cur.execute("INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (product_id, float(quantity), now))
-        iid = cur.lastrowid
+    sql = (f"INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, {_SQL_NOW}) "
+           "ON CONFLICT(product_id) DO UPDATE SET quantity = excluded.quantity, last_updated = excluded.last_updated")
+    if _HAS_RETURNING:
+        cur.execute(sql + " RETURNING id, product_id, quantity, last_updated", (product_id, float(quantity)))
+        row = cur.fetchone()
     else:
-        cur.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?", (float(quantity), now, product_id))
-        # fetch id
-        cur.execute("SELECT id FROM inventory WHERE product_id = ?", (product_id,))
-        iid = cur.fetchone()[0]
+        cur.execute(sql, (product_id, float(quantity)))
+        cur.execute("SELECT id, product_id, quantity, last_updated FROM inventory WHERE product_id = ?", (product_id,))
+        row = cur.fetchone()
     conn.commit()
-    cur.execute("SELECT id, product_id, quantity, last_updated FROM inventory WHERE id = ?", (iid,))
-    row = cur.fetchone()
-    conn.close()
     return dict(row)
 
 
@@ -471,7 +720,6 @@ def delete_inventory(product_id: int, db_path: Path | str | None = None) -> bool
     cur.execute("DELETE FROM inventory WHERE product_id = ?", (product_id,))
     changed = cur.rowcount
     conn.commit()
-    conn.close()
     return bool(changed)
 
 
@@ -481,39 +729,58 @@ def adjust_inventory(product_id: int, delta: float, db_path: Path | str | None =
     """
     conn = connect(db_path)
     cur = conn.cursor()
-    cur.execute("SELECT quantity FROM inventory WHERE product_id = ?", (product_id,))
-    r = cur.fetchone()
-    if r is None:
-        # no inventory row; treat as zero and create if delta positive
-        if delta < 0:
-            conn.close()
-            raise ValueError("insufficient stock")
-        new_q = float(delta)
-        now = datetime.utcnow().isoformat() + 'Z'
-        cur.execute("INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (product_id, new_q, now))
-        conn.commit()
-        conn.close()
-        return new_q
-    else:
-        cur_q = float(r[0])
-        new_q = cur_q + float(delta)
-        if new_q < 0:
-            conn.close()
-            raise ValueError("insufficient stock")
-        now = datetime.utcnow().isoformat() + 'Z'
-        cur.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?", (new_q, now, product_id))
-        conn.commit()
-        conn.close()
-        return new_q
+    delta = float(delta)
+    # a positive delta may create the row; DO NOTHING keeps existing stock
+    if delta >= 0:
+        cur.execute(
+            f"INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, 0, {_SQL_NOW}) "
+            "ON CONFLICT(product_id) DO NOTHING",
+            (product_id,))
+    cur.execute(
+        f"UPDATE inventory SET quantity = quantity + ?, last_updated = {_SQL_NOW} "
+        "WHERE product_id = ? AND quantity + ? >= 0",
+        (delta, product_id, delta))
+    if cur.rowcount == 0:
+        # missing row with a negative delta, or not enough stock
+        conn.rollback()
+        raise ValueError("insufficient stock")
+    conn.commit()
+    cur.execute(_SQL_SELECT_INVENTORY_QTY, (product_id,))
+    return float(cur.fetchone()[0])
+
+
+# --- Password hashing ---
+_PBKDF2_ITERATIONS = 100_000
+
+
+def hash_password(password: str) -> str:
+    """Salted PBKDF2-SHA256 hash in 'pbkdf2$<iterations>$<salt>$<digest>' form."""
+    salt = secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), _PBKDF2_ITERATIONS).hex()
+    return f"pbkdf2${_PBKDF2_ITERATIONS}${salt}${digest}"
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """Check a candidate password against a stored hash (or legacy plaintext)."""
+    if stored.startswith('pbkdf2$'):
+        try:
+            _, iters, salt, digest = stored.split('$', 3)
+            candidate = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), int(iters)).hex()
+            return hmac.compare_digest(candidate, digest)
+        except Exception:
+            return False
+    # rows created before hashing landed hold the plaintext password
+    return hmac.compare_digest(stored, password)
 
 
 def authenticate_user(username: str, password: str, db_path: Path | str | None = None) -> dict | None:
     conn = connect(db_path)
     cur = conn.cursor()
-    cur.execute("SELECT id, username, role FROM users WHERE username = ? AND password = ?", (username, password))
+    cur.execute("SELECT id, username, role, password FROM users WHERE username = ?", (username,))
     r = cur.fetchone()
-    conn.close()
-    return dict(r) if r else None
+    if r is None or not verify_password(password, r['password']):
+        return None
+    return {'id': r['id'], 'username': r['username'], 'role': r['role']}
 
 
 # --- User helpers ---
@@ -523,7 +790,6 @@ def get_user_by_username(username: str, db_path: Path | str | None = None) -> di
     cur = conn.cursor()
     cur.execute("SELECT id, username, role FROM users WHERE username = ?", (username,))
     r = cur.fetchone()
-    conn.close()
     return dict(r) if r else None
 
 
@@ -533,31 +799,47 @@ def create_user(username: str, password: str = '', role: str = 'user', db_path:
     """
     conn = connect(db_path)
     cur = conn.cursor()
-    try:
-        cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", (username, password or '', role))
-        conn.commit()
-        uid = cur.lastrowid
-    except Exception:
-        # probably already exists; fall back to selecting
-        cur.execute("SELECT id FROM users WHERE username = ?", (username,))
-        r = cur.fetchone()
-        uid = r[0] if r else None
-    if uid is None:
-        conn.close()
-        return get_user_by_username(username, db_path)
-    cur.execute("SELECT id, username, role FROM users WHERE id = ?", (uid,))
-    row = cur.fetchone()
-    conn.close()
+    sql = "INSERT INTO users (username, password, role) VALUES (?, ?, ?) ON CONFLICT(username) DO NOTHING"
+    params = (username, hash_password(password) if password else '', role)
+    row = None
+    if _HAS_RETURNING:
+        cur.execute(sql + " RETURNING id, username, role", params)
+        row = cur.fetchone()
+    else:
+        cur.execute(sql, params)
+    if row is None:
+        # conflict: the user already existed, return that row
+        cur.execute("SELECT id, username, role FROM users WHERE username = ?", (username,))
+        row = cur.fetchone()
+    conn.commit()
     return dict(row)
 
 
+def get_product_name(product_id: int, db_path: Path | str | None = None) -> str | None:
+    """Return a product's name, or None if the product doesn't exist."""
+    conn = connect(db_path)
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM products WHERE id = ?", (product_id,))
+    r = cur.fetchone()
+    return r[0] if r else None
+
+
+def delete_product_source(product_id: int, db_path: Path | str | None = None) -> bool:
+    conn = connect(db_path)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM product_sources WHERE product_id = ?", (product_id,))
+    changed = cur.rowcount
+    conn.commit()
+    _invalidate_product_caches()
+    return bool(changed)
+
+
 def list_products(db_path: Path | str | None = None):
     conn = connect(db_path)
     cur = conn.cursor()
+    cur.row_factory = None
     cur.execute("SELECT id, name, unit_price FROM products ORDER BY id")
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return [dict(zip(_PRODUCT_COLS, row)) for row in cur.fetchall()]
 
 
 def record_sale(product_id: int, quantity: int = 1, db_path: Path | str | None = None) -> dict:
@@ -565,20 +847,80 @@ def record_sale(product_id: int, quantity: int = 1, db_path: Path | str | None =
     return record_order(product_id=product_id, quantity=quantity, payment_method='Cash', db_path=db_path)
 
 
+def _parse_order_ts(order_date: str | None, client_timestamp: str | None) -> str | None:
+    """Resolve the sale timestamp from caller-supplied values.
+
+    client_timestamp (ISO8601, offset-aware preferred) wins over order_date
+    (YYYY-MM-DD or ISO datetime). Returns the normalized UTC 'Z' string, or
+    None when neither was provided so callers can fall back to server now.
+    """
+    od_dt = None
+    if client_timestamp:
+        # client_timestamp expected to be ISO8601 with offset (e.g. 2025-12-11T14:03:00+03:00)
+        try:
+            log.debug("Received client_timestamp: %r", client_timestamp)
+            cd = datetime.fromisoformat(client_timestamp)
+            # If offset-aware, normalize to UTC
+            if cd.tzinfo is not None:
+                od_dt = cd.astimezone(timezone.utc).replace(tzinfo=None)
+            else:
+                # Treat naive client timestamp as local time: convert to UTC assuming it's already UTC
+                od_dt = cd
+            log.debug("Parsed client_timestamp -> UTC naive: %s", od_dt)
+        except Exception as e:
+            log.debug("Failed to parse client_timestamp: %s", e)
+            # fall through to order_date handling
+            od_dt = None
+
+    if od_dt is None and order_date:
+        log.debug("Received order_date: %r", order_date)
+        try:
+            od_dt = datetime.fromisoformat(order_date)
+            log.debug("Parsed order_date as ISO datetime: %s", od_dt)
+        except Exception as e:
+            log.debug("fromisoformat failed for order_date: %s, trying date-only fallback", e)
+            try:
+                d = datetime.strptime(order_date, "%Y-%m-%d").date()
+                now_utc = datetime.utcnow()
+                od_dt = datetime.combine(d, now_utc.time())
+                log.debug("Parsed order_date as date-only, attached current time: %s", od_dt)
+            except Exception:
+                raise ValueError("order_date must be YYYY-MM-DD or an ISO datetime (YYYY-MM-DDTHH:MM)")
+
+    if od_dt is None:
+        return None
+    # ensure not in the future relative to server UTC
+    if od_dt > datetime.utcnow():
+        raise ValueError("order_date cannot be in the future")
+    return od_dt.replace(microsecond=0).isoformat() + 'Z'
+
+
 def record_order(product_id: int, quantity: float = 1, payment_method: str = 'Cash', order_date: str | None = None, created_by: int | None = None, use_bottle: bool = False, bottles_used: int | None = None, bottle_price: float = 0, client_timestamp: str | None = None, db_path: Path | str | None = None) -> dict:
     if quantity <= 0:
         raise ValueError("quantity must be > 0")
     conn = connect(db_path)
     cur = conn.cursor()
-    # perform everything inside a transaction so adjustments + sale are atomic
+    # perform everything inside a transaction so adjustments + sale are atomic.
+    # IMMEDIATE takes the write lock up front: a deferred BEGIN would upgrade
+    # on the first UPDATE and can hit SQLITE_BUSY mid-transaction under
+    # concurrency; busy_timeout (set in _new_connection) makes lock
+    # acquisition wait instead of erroring.
     try:
-        cur.execute("BEGIN")
-        cur.execute("SELECT unit_price, name FROM products WHERE id = ?", (product_id,))
-        r = cur.fetchone()
-        if r is None:
+        cur.execute("BEGIN IMMEDIATE")
+        # product row + source mapping come from the in-process cache; a miss
+        # (e.g. product added by another process) reloads before giving up
+        cache_key = _cache_key(db_path)
+        products, mappings = _product_maps(conn, cache_key)
+        prod = products.get(product_id)
+        if prod is None:
+            _invalidate_product_caches()
+            products, mappings = _product_maps(conn, cache_key)
+            prod = products.get(product_id)
+        if prod is None:
             raise ValueError(f"product id {product_id} not found")
-        unit_price = float(r["unit_price"])
-        product_name = r["name"]
+        product_name, unit_price = prod[0], float(prod[1])
+        m = mappings.get(product_id)
+        mapping = {'source_id': m[0], 'factor': float(m[1])} if m else None
         total = unit_price * quantity
         
         # Add bottle price to total if using bottle
@@ -588,82 +930,37 @@ def record_order(product_id: int, quantity: float = 1, payment_method: str = 'Ca
             if bottles_used is not None:
                 bottles_count = int(bottles_used)
             else:
-                import math
-                bottles_count = int(quantity) if float(quantity).is_integer() else math.ceil(quantity)
+                bottles_count = _bottles_for(quantity)
             total += bottle_price * bottles_count
 
         # determine timestamp. Prefer client_timestamp (device/system time) when provided,
         # otherwise fall back to order_date or server UTC now.
-        od_dt = None
-        if client_timestamp:
-            # client_timestamp expected to be ISO8601 with offset (e.g. 2025-12-11T14:03:00+03:00)
-            try:
-                print(f"DEBUG: Received client_timestamp: {client_timestamp!r}")
-                cd = datetime.fromisoformat(client_timestamp)
-                # If offset-aware, normalize to UTC
-                if cd.tzinfo is not None:
-                    od_dt = cd.astimezone(timezone.utc).replace(tzinfo=None)
-                else:
-                    # Treat naive client timestamp as local time: convert to UTC assuming it's already UTC
-                    od_dt = cd
-                print(f"DEBUG: Parsed client_timestamp -> UTC naive: {od_dt}")
-            except Exception as e:
-                print(f"DEBUG: Failed to parse client_timestamp: {e}")
-                # fall through to order_date handling
-                od_dt = None
-
-        if od_dt is None and order_date:
-            print(f"DEBUG: Received order_date: {order_date!r}")  # DEBUG
-            try:
-                od_dt = datetime.fromisoformat(order_date)
-                print(f"DEBUG: Successfully parsed order_date as ISO datetime: {od_dt}")
-            except Exception as e:
-                print(f"DEBUG: fromisoformat failed for order_date: {e}, trying date-only fallback")
-                try:
-                    d = datetime.strptime(order_date, "%Y-%m-%d").date()
-                    now_utc = datetime.utcnow()
-                    od_dt = datetime.combine(d, now_utc.time())
-                    print(f"DEBUG: Parsed order_date as date-only, attached current time: {od_dt}")
-                except Exception:
-                    raise ValueError("order_date must be YYYY-MM-DD or an ISO datetime (YYYY-MM-DDTHH:MM)")
-
-        if od_dt is not None:
-            # ensure not in the future relative to server UTC
-            if od_dt > datetime.utcnow():
-                raise ValueError("order_date cannot be in the future")
-            ts = od_dt.replace(microsecond=0).isoformat() + 'Z'
-        else:
-            ts = datetime.utcnow().isoformat() + 'Z'
+        ts = _parse_order_ts(order_date, client_timestamp) or _now_iso()
 
-        # perform stock adjustments (source-based preferred)
-        cur.execute("SELECT source_id, factor FROM product_sources WHERE product_id = ?", (product_id,))
-        m = cur.fetchone()
-        mapping = {'source_id': m[0], 'factor': float(m[1])} if m else None
-        now_ts = datetime.utcnow().isoformat() + 'Z'
+        # perform stock adjustments (source-based preferred). Each decrement is a
+        # single guarded UPDATE: the `quantity >= ?` predicate makes the check and
+        # the write one statement, so rowcount == 0 means insufficient stock.
+        now_ts = _now_iso()
 
         if mapping:
-            required = float(quantity) * float(mapping['factor'])
-            cur.execute("SELECT quantity FROM sources WHERE id = ?", (mapping['source_id'],))
-            srow = cur.fetchone()
-            cur_q = float(srow[0]) if srow is not None else 0.0
-            new_q = cur_q - required
-            if new_q < 0:
+            # mapping['factor'] was coerced to float when the dict was built
+            required = float(quantity) * mapping['factor']
+            cur.execute(
+                "UPDATE sources SET quantity = quantity - ?, last_updated = ? WHERE id = ? AND quantity >= ?",
+                (required, now_ts, mapping['source_id'], required))
+            if cur.rowcount == 0:
                 raise ValueError('insufficient stock for this order')
-            cur.execute("UPDATE sources SET quantity = ?, last_updated = ? WHERE id = ?", (new_q, now_ts, mapping['source_id']))
-            cur.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", ('source', mapping['source_id'], -required, f'order:{product_id}', now_ts, created_by))
+            cur.execute(_SQL_INSERT_MOVEMENT, ('source', mapping['source_id'], -required, f'order:{product_id}', now_ts, created_by))
         else:
-            # fallback to product inventory
-            cur.execute("SELECT quantity FROM inventory WHERE product_id = ?", (product_id,))
-            irow = cur.fetchone()
-            cur_q = float(irow[0]) if irow is not None else 0.0
-            new_q = cur_q - float(quantity)
-            if new_q < 0:
+            # fallback to product inventory; a missing row counts as zero stock,
+            # and quantity > 0 is already validated, so rowcount == 0 covers both
+            required = float(quantity)
+            cur.execute(
+                "UPDATE inventory SET quantity = quantity - ?, last_updated = ? WHERE product_id = ? AND quantity >= ?",
+                (required, now_ts, product_id, required))
+            if cur.rowcount == 0:
                 raise ValueError('insufficient stock for this order')
-            if irow is None:
-                cur.execute("INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (product_id, new_q, now_ts))
-            else:
-                cur.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?", (new_q, now_ts, product_id))
-            cur.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", ('inventory', product_id, -float(quantity), f'order:{product_id}', now_ts, created_by))
+            cur.execute(_SQL_INSERT_MOVEMENT, ('inventory', product_id, -required, f'order:{product_id}', now_ts, created_by))
 
         # optional: decrement bottle inventory when requested or when `bottles_used` provided
         bottles_to_consume = None
@@ -675,173 +972,279 @@ def record_order(product_id: int, quantity: float = 1, payment_method: str = 'Ca
             if bottles_to_consume < 0:
                 raise ValueError('bottles_used cannot be negative')
         elif use_bottle:
-            # compute bottles based on product size (existing behavior)
-            bottle_pid = None
-            try:
-                if mapping:
-                    bottle_name = f"Empty {int(mapping['factor'])}L bottle"
-                    cur.execute("SELECT id FROM products WHERE name = ?", (bottle_name,))
-                    prow = cur.fetchone()
-                    if prow:
-                        bottle_pid = prow[0]
-                if bottle_pid is None:
-                    cur.execute("SELECT id FROM products WHERE name LIKE ?", ("%Empty%",))
-                    prow = cur.fetchone()
-                    if prow:
-                        bottle_pid = prow[0]
-            except Exception:
-                bottle_pid = None
+            bottles_to_consume = _bottles_for(quantity)
 
-            if bottle_pid is not None:
-                import math
-                bottles_to_consume = int(quantity) if float(quantity).is_integer() else math.ceil(quantity)
-
-        # if we have a bottle count to consume, perform inventory decrement
+        # if we have a bottle count to consume, resolve the bottle product
+        # (cached per database/size) and do the decrement + movement as two
+        # statements — the guarded UPDATE already merges the
+        # check/insert/update into one round-trip.
         if bottles_to_consume is not None and bottles_to_consume > 0:
-            # find bottle product id if not already determined
-            if 'bottle_pid' not in locals() or bottle_pid is None:
-                bottle_pid = None
-                try:
-                    if mapping:
-                        bottle_name = f"Empty {int(mapping['factor'])}L bottle"
-                        cur.execute("SELECT id FROM products WHERE name = ?", (bottle_name,))
-                        prow = cur.fetchone()
-                        if prow:
-                            bottle_pid = prow[0]
-                    if bottle_pid is None:
-                        cur.execute("SELECT id FROM products WHERE name LIKE ?", ("%Empty%",))
-                        prow = cur.fetchone()
-                        if prow:
-                            bottle_pid = prow[0]
-                except Exception:
-                    bottle_pid = None
+            bottle_pid = _bottle_pid(cur, cache_key, mapping['factor'] if mapping else None)
 
             if bottle_pid is not None:
-                cur.execute("SELECT quantity FROM inventory WHERE product_id = ?", (bottle_pid,))
-                brow = cur.fetchone()
-                cur_q = float(brow[0]) if brow else 0.0
-                new_bq = cur_q - bottles_to_consume
-                if new_bq < 0:
+                cur.execute(
+                    "UPDATE inventory SET quantity = quantity - ?, last_updated = ? WHERE product_id = ? AND quantity >= ?",
+                    (bottles_to_consume, now_ts, bottle_pid, bottles_to_consume))
+                if cur.rowcount == 0:
                     raise ValueError('insufficient bottle stock for this order')
-                if brow is None:
-                    cur.execute("INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (bottle_pid, new_bq, now_ts))
-                else:
-                    cur.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?", (new_bq, now_ts, bottle_pid))
-                cur.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", ('inventory', bottle_pid, -bottles_to_consume, f'order_bottle:{product_id}', now_ts, created_by))
-
-        # insert sale row (include bottles_used and bottle_price when columns exist)
-        cols = [c[1] for c in cur.execute("PRAGMA table_info(sales)").fetchall()]
-        fields = ["product_id", "quantity", "unit_price", "total", "payment_method", "timestamp"]
+                cur.execute(_SQL_INSERT_MOVEMENT, ('inventory', bottle_pid, -bottles_to_consume, f'order_bottle:{product_id}', now_ts, created_by))
+            elif bottles_used is None:
+                # derived from use_bottle but no bottle product exists: keep the
+                # old behavior of recording bottles_used = 0 on the sale
+                bottles_to_consume = None
+
+        # insert sale row via the per-database prebuilt SQL (optional columns
+        # like bottles_used/bottle_price are part of the cached field order)
+        fields, insert_sql, select_sql = _sales_sql(cur, cache_key)
+        optional_values = {
+            'created_by': created_by,
+            # already an int (or None) by the time it reaches here
+            'bottles_used': bottles_to_consume or 0,
+            'bottle_price': bottle_price if use_bottle else 0,
+            'client_timestamp': client_timestamp,
+        }
         params = [product_id, quantity, unit_price, total, payment_method, ts]
-        if 'created_by' in cols:
-            fields.append('created_by')
-            params.append(created_by)
-        # persist bottles_used (0 if none)
-        if 'bottles_used' in cols:
-            fields.append('bottles_used')
-            params.append(int(bottles_to_consume) if bottles_to_consume is not None else 0)
-        # persist bottle_price
-        if 'bottle_price' in cols:
-            fields.append('bottle_price')
-            params.append(bottle_price if use_bottle else 0)
-        # include optional client_timestamp if present
-        if 'client_timestamp' in cols:
-            fields.append('client_timestamp')
-            params.append(client_timestamp)
-        placeholders = ', '.join(['?'] * len(fields))
-        sql = f"INSERT INTO sales ({', '.join(fields)}) VALUES ({placeholders})"
-        cur.execute(sql, tuple(params))
+        params.extend(optional_values[f] for f in fields[6:])
+        cur.execute(insert_sql, params)
         sale_id = cur.lastrowid
         conn.commit()
-        # return sale including bottles_used/bottle_price/created_by when available
-        select_cols = ["s.id", "s.product_id", "p.name as product_name", "s.quantity", "s.unit_price", "s.total", "s.payment_method", "s.timestamp"]
-        if 'created_by' in cols:
-            select_cols.append('s.created_by')
-        if 'bottles_used' in cols:
-            select_cols.append('s.bottles_used')
-        if 'bottle_price' in cols:
-            select_cols.append('s.bottle_price')
-        if 'client_timestamp' in cols:
-            select_cols.append('s.client_timestamp')
-        sql = f"SELECT {', '.join(select_cols)} FROM sales s JOIN products p ON p.id = s.product_id WHERE s.id = ?"
-        cur.execute(sql, (sale_id,))
+        # return sale including the optional columns when available
+        cur.execute(select_sql, (sale_id,))
         sale = dict(cur.fetchone())
-        conn.close()
         return sale
     except Exception as e:
         try:
             conn.rollback()
         except Exception:
             pass
-        conn.close()
         # Re-raise so callers (API layer) receive an exception and can return
         # a proper HTTP error instead of returning null/None to the client.
         raise
 
+
+def record_sales_batch(orders: list, db_path: Path | str | None = None) -> list:
+    """Record several orders inside one transaction.
+
+    Each entry is a dict with the same keys as record_order's arguments
+    (product_id required, quantity defaulting to 1). Stock checks still run
+    per order — any failure rolls the whole batch back — but the sale and
+    movement INSERTs go through executemany and the batch pays a single
+    commit/fsync instead of one per order.
+
+    Returns the inserted sale rows (same shape as record_order) in input order.
+    """
+    if not orders:
+        return []
+    conn = connect(db_path)
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        cache_key = _cache_key(db_path)
+        products, mappings = _product_maps(conn, cache_key)
+        fields, insert_sql, select_sql = _sales_sql(cur, cache_key)
+        now_ts = _now_iso()
+        sale_rows = []
+        movement_rows = []
+        for o in orders:
+            product_id = o['product_id']
+            quantity = o.get('quantity', 1)
+            if quantity <= 0:
+                raise ValueError("quantity must be > 0")
+            prod = products.get(product_id)
+            if prod is None:
+                _invalidate_product_caches()
+                products, mappings = _product_maps(conn, cache_key)
+                prod = products.get(product_id)
+            if prod is None:
+                raise ValueError(f"product id {product_id} not found")
+            unit_price = float(prod[1])
+            m = mappings.get(product_id)
+            factor = float(m[1]) if m else None
+            created_by = o.get('created_by')
+            use_bottle = bool(o.get('use_bottle'))
+            bottle_price = float(o.get('bottle_price') or 0)
+            bottles_used = o.get('bottles_used')
+            if bottles_used is not None:
+                try:
+                    bottles = int(bottles_used)
+                except Exception:
+                    raise ValueError('bottles_used must be an integer')
+                if bottles < 0:
+                    raise ValueError('bottles_used cannot be negative')
+            elif use_bottle:
+                bottles = _bottles_for(quantity)
+            else:
+                bottles = 0
+
+            total = unit_price * quantity
+            if use_bottle and bottle_price > 0:
+                # bottles is already resolved (explicit count or derived from
+                # quantity); an explicit 0 charges nothing, like record_order
+                total += bottle_price * bottles
+            ts = _parse_order_ts(o.get('order_date'), o.get('client_timestamp')) or now_ts
+
+            # stock decrement: guarded UPDATEs stay per-order because the
+            # rowcount check is what detects insufficient stock
+            if m:
+                required = float(quantity) * factor
+                cur.execute(
+                    "UPDATE sources SET quantity = quantity - ?, last_updated = ? WHERE id = ? AND quantity >= ?",
+                    (required, now_ts, m[0], required))
+                if cur.rowcount == 0:
+                    raise ValueError('insufficient stock for this order')
+                movement_rows.append(('source', m[0], -required, f'order:{product_id}', now_ts, created_by))
+            else:
+                required = float(quantity)
+                cur.execute(
+                    "UPDATE inventory SET quantity = quantity - ?, last_updated = ? WHERE product_id = ? AND quantity >= ?",
+                    (required, now_ts, product_id, required))
+                if cur.rowcount == 0:
+                    raise ValueError('insufficient stock for this order')
+                movement_rows.append(('inventory', product_id, -required, f'order:{product_id}', now_ts, created_by))
+
+            if bottles > 0:
+                bottle_pid = _bottle_pid(cur, cache_key, factor)
+                if bottle_pid is not None:
+                    cur.execute(
+                        "UPDATE inventory SET quantity = quantity - ?, last_updated = ? WHERE product_id = ? AND quantity >= ?",
+                        (bottles, now_ts, bottle_pid, bottles))
+                    if cur.rowcount == 0:
+                        raise ValueError('insufficient bottle stock for this order')
+                    movement_rows.append(('inventory', bottle_pid, -bottles, f'order_bottle:{product_id}', now_ts, created_by))
+                elif bottles_used is None:
+                    bottles = 0
+
+            optional_values = {
+                'created_by': created_by,
+                'bottles_used': bottles,
+                'bottle_price': bottle_price if use_bottle else 0,
+                'client_timestamp': o.get('client_timestamp'),
+            }
+            row = [product_id, quantity, unit_price, total, o.get('payment_method', 'Cash'), ts]
+            row.extend(optional_values[f] for f in fields[6:])
+            sale_rows.append(tuple(row))
+
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM sales")
+        last_id = cur.fetchone()[0]
+        if movement_rows:
+            cur.executemany(_SQL_INSERT_MOVEMENT, movement_rows)
+        cur.executemany(insert_sql, sale_rows)
+        # executemany doesn't report rowids; read the new rows back while the
+        # transaction still holds the write lock, so rows above the pre-insert
+        # MAX(id) are exactly this batch and never a concurrent writer's
+        cur.execute(select_sql.replace("WHERE s.id = ?", "WHERE s.id > ? ORDER BY s.id"), (last_id,))
+        result = [dict(r) for r in cur.fetchall()]
+        conn.commit()
+        return result
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+
+
 # --- Price history helpers ---
-def get_price_history(product_id: int, db_path: Path | str | None = None):
+def iter_price_history(product_id: int, db_path: Path | str | None = None):
+    """Yield price-history rows as dicts, newest first, straight off the cursor."""
     conn = connect(db_path)
     cur = conn.cursor()
+    cur.row_factory = None
     cur.execute("SELECT id, product_id, old_price, new_price, changed_by, timestamp, reason FROM price_history WHERE product_id = ? ORDER BY id DESC", (product_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
-    
+    for row in cur:
+        yield dict(zip(_PRICE_HISTORY_COLS, row))
 
 
-def list_sales(db_path: Path | str | None = None):
+def get_price_history(product_id: int, db_path: Path | str | None = None):
+    return list(iter_price_history(product_id, db_path))
+
+
+def _sale_select_keys(cols: tuple, with_payment: bool) -> tuple:
+    """(select expressions, result keys) for a sales listing, honoring the
+    optional columns present in this database."""
+    select_cols = ["s.id", "s.product_id", "p.name as product_name", "s.quantity", "s.unit_price", "s.total"]
+    keys = ["id", "product_id", "product_name", "quantity", "unit_price", "total"]
+    if with_payment:
+        select_cols.append("s.payment_method")
+        keys.append("payment_method")
+    select_cols.append("s.timestamp")
+    keys.append("timestamp")
+    for c in ('created_by', 'bottles_used', 'bottle_price'):
+        if c in cols:
+            select_cols.append(f"s.{c}")
+            keys.append(c)
+    return select_cols, tuple(keys)
+
+
+# per-database prebuilt listing SQL: the sales/orders queries come in a
+# handful of fixed shapes ((date?, user?) for orders), so build each shape
+# once and pick among them instead of reassembling strings per call
+_list_sql_cache: dict = {}
+
+
+def _list_sql(cur, key: str):
+    entry = _list_sql_cache.get(key)
+    if entry is None:
+        cols = _sales_cols(cur, key)
+        sales_cols, sales_keys = _sale_select_keys(cols, with_payment=False)
+        orders_cols, orders_keys = _sale_select_keys(cols, with_payment=True)
+        sales_sql = f"SELECT {', '.join(sales_cols)} FROM sales s JOIN products p ON p.id = s.product_id ORDER BY s.id DESC"
+        base = f"SELECT {', '.join(orders_cols)} FROM sales s JOIN products p ON p.id = s.product_id"
+        date_w = "s.timestamp >= ? AND s.timestamp < ?"
+        user_w = "s.created_by = ?"
+        tail = " ORDER BY s.id DESC"
+        orders_sql = {
+            (False, False): base + tail,
+            (True, False): f"{base} WHERE {date_w}{tail}",
+            (False, True): f"{base} WHERE {user_w}{tail}",
+            (True, True): f"{base} WHERE {date_w} AND {user_w}{tail}",
+        }
+        entry = (sales_sql, sales_keys, orders_sql, orders_keys)
+        _list_sql_cache[key] = entry
+    return entry
+
+
+def iter_sales(db_path: Path | str | None = None):
+    """Yield all sales as dicts, newest first, without materializing the list."""
     conn = connect(db_path)
     cur = conn.cursor()
-    # Include optional columns (bottles_used, bottle_price, created_by) if they exist in the sales table
-    cols = [c[1] for c in cur.execute("PRAGMA table_info(sales)").fetchall()]
-    select_cols = ["s.id", "s.product_id", "p.name as product_name", "s.quantity", "s.unit_price", "s.total", "s.timestamp"]
-    if 'created_by' in cols:
-        select_cols.append('s.created_by')
-    if 'bottles_used' in cols:
-        select_cols.append('s.bottles_used')
-    if 'bottle_price' in cols:
-        select_cols.append('s.bottle_price')
-    sql = f"SELECT {', '.join(select_cols)} FROM sales s JOIN products p ON p.id = s.product_id ORDER BY s.id DESC"
-    cur.execute(sql)
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    cur.row_factory = None
+    sales_sql, keys, _, _ = _list_sql(cur, _cache_key(db_path))
+    cur.execute(sales_sql)
+    for row in cur:
+        yield dict(zip(keys, row))
 
 
-def list_orders(db_path: Path | str | None = None, date_iso: str | None = None, user_id: int | None = None):
+def list_sales(db_path: Path | str | None = None):
+    return list(iter_sales(db_path))
+
+
+def iter_orders(db_path: Path | str | None = None, date_iso: str | None = None, user_id: int | None = None):
+    """Yield orders as dicts, newest first, optionally filtered by UTC date or user."""
     conn = connect(db_path)
     cur = conn.cursor()
+    cur.row_factory = None
+    _, _, orders_sql, keys = _list_sql(cur, _cache_key(db_path))
     params = []
-    where_clauses = []
     if date_iso:
-        where_clauses.append("s.timestamp LIKE ?")
-        params.append(f"{date_iso}%")
+        # range instead of LIKE so the timestamp index is usable
+        params.extend(_prefix_bounds(date_iso))
     if user_id is not None:
-        where_clauses.append("s.created_by = ?")
         params.append(user_id)
+    cur.execute(orders_sql[(bool(date_iso), user_id is not None)], tuple(params))
+    for row in cur:
+        yield dict(zip(keys, row))
 
-    where_sql = ("WHERE " + " AND ".join(where_clauses)) if where_clauses else ""
-    # Dynamically include optional columns when present in the sales table
-    cols = [c[1] for c in cur.execute("PRAGMA table_info(sales)").fetchall()]
-    select_cols = ["s.id", "s.product_id", "p.name as product_name", "s.quantity", "s.unit_price", "s.total", "s.payment_method", "s.timestamp"]
-    if 'created_by' in cols:
-        select_cols.append('s.created_by')
-    if 'bottles_used' in cols:
-        select_cols.append('s.bottles_used')
-    if 'bottle_price' in cols:
-        select_cols.append('s.bottle_price')
-
-    sql = f"SELECT {', '.join(select_cols)} FROM sales s JOIN products p ON p.id = s.product_id {where_sql} ORDER BY s.id DESC"
-    cur.execute(sql, tuple(params))
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
 
+def list_orders(db_path: Path | str | None = None, date_iso: str | None = None, user_id: int | None = None):
+    return list(iter_orders(db_path, date_iso, user_id))
 
-def list_movements(limit: int = 100, kind: str | None = None, ref_id: int | None = None, db_path: Path | str | None = None):
-    """Return recent movements (audit) optionally filtered by kind ('source'|'inventory') or ref_id."""
+
+def iter_movements(limit: int = 100, kind: str | None = None, ref_id: int | None = None, db_path: Path | str | None = None):
+    """Yield recent movements (audit) optionally filtered by kind ('source'|'inventory') or ref_id."""
     conn = connect(db_path)
     cur = conn.cursor()
+    cur.row_factory = None
     params = []
     where = []
     if kind:
@@ -854,9 +1257,12 @@ def list_movements(limit: int = 100, kind: str | None = None, ref_id: int | None
     sql = f"SELECT id, kind, ref_id, delta, reason, timestamp, user_id FROM movements {where_sql} ORDER BY id DESC LIMIT ?"
     params.append(int(limit or 100))
     cur.execute(sql, tuple(params))
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    for row in cur:
+        yield dict(zip(_MOVEMENT_COLS, row))
+
+
+def list_movements(limit: int = 100, kind: str | None = None, ref_id: int | None = None, db_path: Path | str | None = None):
+    return list(iter_movements(limit, kind, ref_id, db_path))
 
 
 # --- API logs helpers (audit of incoming requests) ---
@@ -865,44 +1271,165 @@ def log_api_call(method: str, path: str, status: int = 200, user_id: int | None
     """Insert a small audit row for an API request."""
     conn = connect(db_path)
     cur = conn.cursor()
-    now = datetime.utcnow().isoformat() + 'Z'
-    cur.execute("INSERT INTO api_logs (timestamp, user_id, method, path, payload, status, duration_ms, ip) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (now, user_id, method, path, payload, status, duration_ms, ip))
+    now = _now_iso()
+    cur.execute(_SQL_INSERT_API_LOG, (now, user_id, method, path, payload, status, duration_ms, ip))
     conn.commit()
-    conn.close()
 
 
-def list_api_logs(limit: int = 100, db_path: Path | str | None = None):
+# Rows are queued here and flushed by a daemon thread in batches inside one
+# transaction, so the request path never pays a per-request commit. The
+# thread starts lazily on the first log_api call.
+_LOG_QUEUE: queue.Queue = queue.Queue(maxsize=10000)
+_LOG_BATCH_MAX = 500
+_log_thread_started = False
+_log_thread_lock = threading.Lock()
+
+
+def _log_flusher():
+    while True:
+        batch = [_LOG_QUEUE.get()]
+        try:
+            # coalesce whatever arrives within a second, up to the batch cap
+            while len(batch) < _LOG_BATCH_MAX:
+                batch.append(_LOG_QUEUE.get(timeout=1.0))
+        except queue.Empty:
+            pass
+        try:
+            log_api_calls_batch(batch)
+        except Exception:
+            log.exception('failed to flush api_logs batch')
+
+
+def _ensure_log_flusher():
+    global _log_thread_started
+    if _log_thread_started:
+        return
+    with _log_thread_lock:
+        if not _log_thread_started:
+            threading.Thread(target=_log_flusher, daemon=True, name='api-log-flusher').start()
+            _log_thread_started = True
+
+
+def log_api(method: str, path: str, status: int = 200, user_id: int | None = None, payload: str | None = None, duration_ms: int | None = None, ip: str | None = None):
+    """Queue an api_logs row for the background batch writer.
+
+    Drops the row instead of blocking when the queue is full — audit logging
+    must never stall a request.
+    """
+    _ensure_log_flusher()
+    try:
+        _LOG_QUEUE.put_nowait((_now_iso(), user_id, method, path, payload, status, duration_ms, ip))
+    except queue.Full:
+        pass
+
+
+@atexit.register
+def _drain_log_queue():
+    rows = []
+    try:
+        while True:
+            rows.append(_LOG_QUEUE.get_nowait())
+    except queue.Empty:
+        pass
+    if rows:
+        try:
+            log_api_calls_batch(rows)
+        except Exception:
+            pass
+
+
+def log_api_calls_batch(rows, db_path: Path | str | None = None):
+    """Insert many api_logs rows in one transaction.
+
+    Each row is a tuple (timestamp, user_id, method, path, payload, status,
+    duration_ms, ip). Used by the background log flusher above so the request
+    path doesn't pay a commit per request.
+    """
+    if not rows:
+        return
     conn = connect(db_path)
     cur = conn.cursor()
+    cur.executemany(_SQL_INSERT_API_LOG, rows)
+    conn.commit()
+
+
+def iter_api_logs(limit: int = 100, db_path: Path | str | None = None):
+    """Yield recent api_logs rows as dicts, newest first."""
+    conn = connect(db_path)
+    cur = conn.cursor()
+    cur.row_factory = None
     sql = "SELECT id, timestamp, user_id, method, path, payload, status, duration_ms, ip FROM api_logs ORDER BY id DESC LIMIT ?"
     cur.execute(sql, (int(limit or 100),))
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    for row in cur:
+        yield dict(zip(_API_LOG_COLS, row))
+
+
+def list_api_logs(limit: int = 100, db_path: Path | str | None = None):
+    return list(iter_api_logs(limit, db_path))
+
+
+def bulk_dump(db_path: Path | str | None = None) -> dict:
+    """Return a snapshot of the main tables for debugging/backup.
+
+    Runs every SELECT on one connection inside a single transaction, so the
+    dump is internally consistent and doesn't pay a connect/close per table
+    the way calling the individual list_* helpers would.
+    """
+    conn = connect(db_path)
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        sales_cols = _sales_cols(cur, _cache_key(db_path))
+        order_cols = ["s.id", "s.product_id", "p.name as product_name", "s.quantity", "s.unit_price", "s.total", "s.payment_method", "s.timestamp"]
+        for opt in ('created_by', 'bottles_used', 'bottle_price'):
+            if opt in sales_cols:
+                order_cols.append(f's.{opt}')
+        orders_sql = f"SELECT {', '.join(order_cols)} FROM sales s JOIN products p ON p.id = s.product_id ORDER BY s.id DESC"
+        dump = {
+            'products': [dict(r) for r in cur.execute("SELECT id, name, unit_price FROM products ORDER BY id").fetchall()],
+            'orders': [dict(r) for r in cur.execute(orders_sql).fetchall()],
+            'inventory': [dict(r) for r in cur.execute("SELECT i.id, i.product_id, p.name as product_name, i.quantity, i.last_updated FROM inventory i JOIN products p ON p.id = i.product_id ORDER BY p.name").fetchall()],
+            'sources': [dict(r) for r in cur.execute("SELECT id, name, unit, quantity, last_updated FROM sources ORDER BY id").fetchall()],
+            'product_sources': [dict(r) for r in cur.execute("SELECT ps.product_id, ps.source_id, ps.factor, p.name as product_name, s.name as source_name FROM product_sources ps JOIN products p ON p.id = ps.product_id JOIN sources s ON s.id = ps.source_id ORDER BY p.name").fetchall()],
+            'movements': [dict(r) for r in cur.execute("SELECT id, kind, ref_id, delta, reason, timestamp, user_id FROM movements ORDER BY id DESC LIMIT 1000").fetchall()],
+            'api_logs': [dict(r) for r in cur.execute("SELECT id, timestamp, user_id, method, path, payload, status, duration_ms, ip FROM api_logs ORDER BY id DESC LIMIT 1000").fetchall()],
+        }
+    finally:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+    return dump
 
 
 def add_product(name: str, unit_price: float, db_path: Path | str | None = None) -> dict:
     conn = connect(db_path)
     cur = conn.cursor()
-    cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", (name, float(unit_price)))
-    pid = cur.lastrowid
+    unit_price = float(unit_price)
+    if _HAS_RETURNING:
+        cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?) RETURNING id, name, unit_price", (name, unit_price))
+        row = cur.fetchone()
+        pid = row['id']
+    else:
+        cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", (name, unit_price))
+        pid = cur.lastrowid
+        cur.execute("SELECT id, name, unit_price FROM products WHERE id = ?", (pid,))
+        row = cur.fetchone()
     # record initial price in price_history
-    now = datetime.utcnow().isoformat() + 'Z'
     try:
-        cur.execute("INSERT INTO price_history (product_id, old_price, new_price, changed_by, timestamp, reason) VALUES (?, ?, ?, ?, ?, ?)", (pid, None, float(unit_price), None, now, 'initial'))
+        cur.execute(f"INSERT INTO price_history (product_id, old_price, new_price, changed_by, timestamp, reason) VALUES (?, ?, ?, ?, {_SQL_NOW}, ?)", (pid, None, unit_price, None, 'initial'))
     except Exception:
         # ignore if price_history doesn't exist
         pass
     conn.commit()
-    cur.execute("SELECT id, name, unit_price FROM products WHERE id = ?", (pid,))
-    row = cur.fetchone()
-    conn.close()
+    _invalidate_product_caches()
     return dict(row)
 
 
 def update_product(product_id: int, name: str, unit_price: float, db_path: Path | str | None = None) -> dict:
     conn = connect(db_path)
     cur = conn.cursor()
+    unit_price = float(unit_price)
     # record previous price for history (best-effort)
     try:
         cur.execute("SELECT unit_price FROM products WHERE id = ?", (product_id,))
@@ -910,16 +1437,19 @@ def update_product(product_id: int, name: str, unit_price: float, db_path: Path
         prev_price = float(prev[0]) if prev and prev[0] is not None else None
     except Exception:
         prev_price = None
-    cur.execute("UPDATE products SET name = ?, unit_price = ? WHERE id = ?", (name, float(unit_price), product_id))
-    now = datetime.utcnow().isoformat() + 'Z'
+    if _HAS_RETURNING:
+        cur.execute("UPDATE products SET name = ?, unit_price = ? WHERE id = ? RETURNING id, name, unit_price", (name, unit_price, product_id))
+        row = cur.fetchone()
+    else:
+        cur.execute("UPDATE products SET name = ?, unit_price = ? WHERE id = ?", (name, unit_price, product_id))
+        cur.execute("SELECT id, name, unit_price FROM products WHERE id = ?", (product_id,))
+        row = cur.fetchone()
     try:
-        cur.execute("INSERT INTO price_history (product_id, old_price, new_price, changed_by, timestamp, reason) VALUES (?, ?, ?, ?, ?, ?)", (product_id, prev_price, float(unit_price), None, now, 'update'))
+        cur.execute(f"INSERT INTO price_history (product_id, old_price, new_price, changed_by, timestamp, reason) VALUES (?, ?, ?, ?, {_SQL_NOW}, ?)", (product_id, prev_price, unit_price, None, 'update'))
     except Exception:
         pass
     conn.commit()
-    cur.execute("SELECT id, name, unit_price FROM products WHERE id = ?", (product_id,))
-    row = cur.fetchone()
-    conn.close()
+    _invalidate_product_caches()
     return dict(row) if row else None
 
 
@@ -929,19 +1459,36 @@ def delete_product(product_id: int, db_path: Path | str | None = None) -> bool:
     cur.execute("DELETE FROM products WHERE id = ?", (product_id,))
     changed = cur.rowcount
     conn.commit()
-    conn.close()
+    _invalidate_product_caches()
     return bool(changed)
 
 
 def daily_summary(date_iso: str | None = None, db_path: Path | str | None = None) -> dict:
     """Return totals (quantity and money) for a specific UTC date (YYYY-MM-DD). If date_iso is None use today's UTC date."""
-    from datetime import datetime, timezone
     if date_iso is None:
         date_iso = datetime.utcnow().date().isoformat()
     conn = connect(db_path)
     cur = conn.cursor()
-    # sum quantity and total for rows whose timestamp starts with date_iso
-    cur.execute("SELECT SUM(quantity) as qty, SUM(total) as money FROM sales WHERE timestamp LIKE ?", (f"{date_iso}%",))
+    # sum quantity and total for rows whose timestamp starts with date_iso;
+    # expressed as a range so the aggregation reads only that day's index slice
+    cur.execute("SELECT SUM(quantity) as qty, SUM(total) as money FROM sales WHERE timestamp >= ? AND timestamp < ?", _prefix_bounds(date_iso))
     r = cur.fetchone()
-    conn.close()
     return {"date": date_iso, "total_quantity": int(r[0] or 0), "total_money": float(r[1] or 0.0)}
+
+
+def daily_summary_range(start_iso: str, end_iso: str, db_path: Path | str | None = None) -> list:
+    """Per-day totals for the inclusive date span [start_iso, end_iso].
+
+    One indexed GROUP BY over the range instead of a daily_summary call per
+    date, so a 90-day dashboard costs a single query; the aggregation runs
+    inside SQLite rather than a Python loop. Days with no sales are omitted.
+    """
+    conn = connect(db_path)
+    cur = conn.cursor()
+    cur.row_factory = None
+    hi = _prefix_bounds(end_iso)[1]
+    cur.execute(
+        "SELECT substr(timestamp, 1, 10) AS d, SUM(quantity), SUM(total) FROM sales "
+        "WHERE timestamp >= ? AND timestamp < ? GROUP BY d ORDER BY d",
+        (start_iso, hi))
+    return [{"date": d, "total_quantity": int(q or 0), "total_money": float(m or 0.0)} for d, q, m in cur]
@@ -0,0 +1,28 @@
+"""Gunicorn configuration for the ERP prototype.
+
+Run with:
+  gunicorn -c gunicorn_conf.py app:app
+
+The workload is I/O-bound (SQLite calls, static files, uploads), so we use
+threaded workers by default to keep requests from serializing behind one
+another the way the Werkzeug dev server does. If gevent is installed you can
+switch to async workers with GUNICORN_WORKER_CLASS=gevent.
+
+All values can be overridden via environment variables for deployment.
+"""
+import multiprocessing
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+
+# 2*cpu+1 is the usual starting point for I/O-bound apps
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# keep connections open so the SPA doesn't pay a TCP handshake per poll
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+accesslog = os.environ.get("GUNICORN_ACCESSLOG")  # e.g. '-' for stdout
+errorlog = "-"
@@ -1,20 +1,33 @@
 #!/usr/bin/env python3
-"""Utility: print recent DB dump to stdout for manual inspection."""
-from pprint import pprint
+"""Utility: stream recent DB contents to stdout as JSONL for manual inspection.
+
+One tab-separated `table<TAB>json` line per row, so the output is pipeable
+(grep/jq) and rows are printed as they come off the cursor instead of
+materializing and pprint-formatting whole lists.
+"""
+import json
 import db
 
+try:
+    import orjson
+
+    def _dump(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _dump(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+
+def _emit(table, rows):
+    for row in rows:
+        print(f'{table}\t{_dump(row)}')
+
+
 if __name__ == '__main__':
-    print("Products:")
-    pprint(db.list_products())
-    print('\nOrders (latest 200):')
-    pprint(db.list_orders())
-    print('\nInventory:')
-    pprint(db.list_inventory())
-    print('\nSources:')
-    pprint(db.list_sources())
-    print('\nProduct sources:')
-    pprint(db.list_product_sources())
-    print('\nMovements (latest 1000):')
-    pprint(db.list_movements(limit=1000))
-    print('\nAPI logs (latest 200):')
-    pprint(db.list_api_logs(limit=200))
+    _emit('products', db.list_products())
+    _emit('orders', db.iter_orders())
+    _emit('inventory', db.list_inventory())
+    _emit('sources', db.list_sources())
+    _emit('product_sources', db.list_product_sources())
+    _emit('movements', db.iter_movements(limit=1000))
+    _emit('api_logs', db.iter_api_logs(limit=200))